@@ -0,0 +1,551 @@
+"""
+Benchmarks for StringBooleanExpression.
+
+Run with: python benchmark_stringbooleanexpression.py [comparisons]
+          python benchmark_stringbooleanexpression.py suite --output results.json
+          python benchmark_stringbooleanexpression.py compare baseline.json results.json
+
+The comparisons print how the optimizations compare with what they replaced. The suite measures every stage of
+building and evaluating an expression separately and writes the results as JSON, so runs from different commits can be
+compared to catch performance regressions. Only the standard library is needed, NumPy is used by check_many when it is
+installed.
+"""
+import argparse
+import datetime
+import gc
+import json
+import math
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import stringbooleanexpression
+from stringbooleanexpression import RuleSet, StringBooleanExpression, load_rules, RULE_CACHE_SUFFIX, \
+    IncrementalEvaluator, Dataset, count_parallel, filter_jsonl, filter_sqlite, find_duplicate_rules
+
+COMPLEX_EXAMPLE = ("something with a space==S$name||"
+                   "(S$name==bob||jim==S$name||(EMPTY_STRING==S$name&&S$name==EMPTY_STRING&&F$salary>=10.5))")
+
+# The command that was generated for COMPLEX_EXAMPLE before constants were folded and casts were hoisted
+COMPLEX_EXAMPLE_UNFOLDED = ('str("something with a space") == str(__E__name__E__) or (str(__E__name__E__) == str("bob") '
+                            'or str("jim") == str(__E__name__E__) or (str("") == str(__E__name__E__) and '
+                            'str(__E__name__E__) == str("") and float(__E__salary__E__) >= float(10.5)))')
+
+RECORDS = [{"name": "", "salary": 0}, {"name": "", "salary": 10.5}, {"name": "bob", "salary": 0},
+           {"name": "jim", "salary": 0}, {"name": "something with a space", "salary": 0}]
+
+
+def best_time_per_call(function, number: int = 20000, repeat: int = 5) -> float:
+    """
+    Times a function and returns the fastest run
+    :param function: The function to time, called without arguments
+    :param number: How many calls make up one run
+    :param repeat: How many runs to take the fastest of
+    :return: The time per call in nanoseconds
+    """
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e9
+
+
+def benchmark_constant_folding() -> None:
+    """
+    Compares the per-call cost of the generated command against the unfolded command it replaced
+    """
+    expression = StringBooleanExpression(COMPLEX_EXAMPLE)
+    unfolded = eval("lambda __E__name__E__, __E__salary__E__: " + COMPLEX_EXAMPLE_UNFOLDED, {})
+
+    for record in RECORDS:
+        arguments = [record[item] for item in expression._sorted_variables]
+        folded_time = best_time_per_call(lambda: expression._command(*arguments))
+        unfolded_time = best_time_per_call(lambda: unfolded(*arguments))
+        print(f"{str(record):<50} unfolded {unfolded_time:8.1f} ns  folded {folded_time:8.1f} ns  "
+              f"speedup {unfolded_time / folded_time:5.2f}x")
+
+
+def benchmark_bind() -> None:
+    """
+    Compares check on dictionaries with the function from bind on tuples of the same records
+    """
+    expression = StringBooleanExpression(COMPLEX_EXAMPLE)
+    schema = ["id", "name", "department", "salary"]
+    bound = expression.bind(schema)
+
+    for record in RECORDS:
+        row = (1, record["name"], "sales", record["salary"])
+        check_time = best_time_per_call(lambda: expression.check(dict(zip(schema, row))))
+        bind_time = best_time_per_call(lambda: bound(row))
+        print(f"{str(row):<50} dict + check {check_time:8.1f} ns  bind {bind_time:8.1f} ns  "
+              f"speedup {check_time / bind_time:5.2f}x")
+
+
+def benchmark_instrumentation() -> None:
+    """
+    Shows that check costs the same on an expression that never had instrumentation enabled and on one that had it
+    enabled and disabled again, and what check costs while instrumentation is enabled
+    """
+    expression = StringBooleanExpression(COMPLEX_EXAMPLE)
+    disabled = StringBooleanExpression(COMPLEX_EXAMPLE)
+    disabled.enable_instrumentation()
+    disabled.disable_instrumentation()
+    enabled = StringBooleanExpression(COMPLEX_EXAMPLE)
+    enabled.enable_instrumentation()
+    print(f"disabled check is the method of the class: {disabled.check.__func__ is StringBooleanExpression.check}")
+
+    for record in RECORDS:
+        # More runs than the other benchmarks since the first two times are expected to be equal
+        check_time = best_time_per_call(lambda: expression.check(record), repeat=15)
+        disabled_time = best_time_per_call(lambda: disabled.check(record), repeat=15)
+        enabled_time = best_time_per_call(lambda: enabled.check(record), repeat=15)
+        print(f"{str(record):<50} check {check_time:8.1f} ns  disabled {disabled_time:8.1f} ns "
+              f"({disabled_time / check_time:4.2f}x)  enabled {enabled_time:8.1f} ns ({enabled_time / check_time:4.2f}x)")
+
+
+def benchmark_adaptive_ordering() -> None:
+    """
+    Compares check with and without adaptive ordering for expressions where a rarely true equality is written after
+    comparisons that are usually true
+    """
+    records = [{"amount": index % 1000, "age": index % 90, "score": (index % 10) / 10, "country": f"c{index % 200}"}
+               for index in range(2000)]
+    for input_string in ["F$amount>>10&&F$amount<<990&&I$age>=5&&F$score<=0.9&&S$country==c7",
+                         "(F$amount>>10&&I$age>=5&&F$score<=0.9&&S$country==c7)||(S$country==c8&&I$age<=20)"]:
+        expression = StringBooleanExpression(input_string)
+        adaptive = StringBooleanExpression(input_string)
+        adaptive.enable_adaptive_ordering(sample_size=len(records))
+        for record in records:
+            adaptive.check(record)
+
+        check_time = best_time_per_call(lambda: [expression.check(record) for record in records], number=20)
+        adaptive_time = best_time_per_call(lambda: [adaptive.check(record) for record in records], number=20)
+        print(f"{input_string}\n  reordered to {adaptive._adaptive_ordering.tree}\n"
+              f"  check {check_time / len(records):8.1f} ns  adaptive {adaptive_time / len(records):8.1f} ns  "
+              f"speedup {check_time / adaptive_time:5.2f}x")
+
+
+def benchmark_construction() -> None:
+    """
+    Shows that constructing an expression scales linearly with the length of the input string
+    """
+    for size in [10, 100, 1000]:
+        input_string = "||".join(f"(S$name==name{index}&&F$salary>={index}.5)" for index in range(size))
+        parse_time = best_time_per_call(lambda: StringBooleanExpression._parse_input(input_string, {}),
+                                        number=max(1, 2000 // size))
+        construction_time = best_time_per_call(lambda: StringBooleanExpression(input_string),
+                                               number=max(1, 2000 // size))
+        print(f"{size:>5} comparison pairs  {len(input_string):>7} chars  "
+              f"parse {parse_time / size / 1000:6.2f} us/pair  construct {construction_time / size / 1000:6.2f} us/pair")
+
+
+def benchmark_rule_set() -> None:
+    """
+    Compares matching a record against a RuleSet with calling check on every rule
+    """
+    for size in [100, 1000, 20000]:
+        rules = {index: f"S$country==c{index % 200}&&F$amount>={index % 1000}||S$user==u{index}"
+                 for index in range(size)}
+        rule_set = RuleSet(rules)
+        expressions = [(rule_id, StringBooleanExpression(rule)) for rule_id, rule in rules.items()]
+        record = {"country": "c7", "amount": 120.0, "user": "u42"}
+
+        number = max(1, 20000 // size)
+        rule_set_time = best_time_per_call(lambda: rule_set.match(record), number=number)
+        check_time = best_time_per_call(lambda: [rule_id for rule_id, expression in expressions
+                                                 if expression.check(record)], number=number)
+        print(f"{size:>6} rules  check every rule {check_time / 1000:10.1f} us  "
+              f"RuleSet.match {rule_set_time / 1000:8.1f} us  speedup {check_time / rule_set_time:6.1f}x")
+
+
+def benchmark_incremental(size: int = 300) -> None:
+    """
+    Compares checking every expression again after one field of a record changed with IncrementalEvaluator.update
+    """
+    expressions = {index: f"S$country==c{index % 20}&&F$amount>={index % 1000}||S$status{index % 30}==open"
+                   for index in range(size)}
+    checks = [(expression_id, StringBooleanExpression(expression)) for expression_id, expression in expressions.items()]
+    evaluator = IncrementalEvaluator(expressions)
+    record = {"country": "c7", "amount": 120.0, **{f"status{index}": "closed" for index in range(30)}}
+    evaluator.evaluate("order", record)
+
+    for field in ["status3", "amount", "unused"]:
+        check_time = best_time_per_call(lambda: {expression_id: expression.check(record)
+                                                 for expression_id, expression in checks}, number=200)
+        update_time = best_time_per_call(lambda: evaluator.update("order", record, [field]), number=200)
+        print(f"{size} expressions, {field:<8} changed  check all {check_time / 1000:8.1f} us  "
+              f"update {update_time / 1000:8.1f} us  speedup {check_time / update_time:6.1f}x")
+
+
+def benchmark_sqlite(size: int = 200000) -> None:
+    """
+    Compares reading every row of a SQLite table and filtering with check against filter_sqlite
+    """
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE orders (country TEXT, amount REAL, user TEXT)")
+    connection.executemany("INSERT INTO orders VALUES (?, ?, ?)",
+                           ((f"c{index % 200}", index % 1000, f"u{index}") for index in range(size)))
+    connection.execute("CREATE INDEX orders_country ON orders (country)")
+    columns = ["country", "amount", "user"]
+
+    for input_string in ["S$country==c7&&F$amount>=500", "F$amount>=990||S$user==u42"]:
+        expression = StringBooleanExpression(input_string)
+        start = time.perf_counter()
+        expected = [row for row in connection.execute("SELECT * FROM orders")
+                    if expression.check(dict(zip(columns, row)))]
+        check_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = list(filter_sqlite(expression, connection, "orders"))
+        sqlite_time = time.perf_counter() - start
+        assert rows == expected
+        print(f"{size} rows  {input_string:<30} check {check_time:6.3f} s  filter_sqlite {sqlite_time:6.3f} s  "
+              f"speedup {check_time / sqlite_time:6.1f}x")
+
+
+def benchmark_dataset(size: int = 200000) -> None:
+    """
+    Compares check on every record with Dataset.query, the time of the first query includes building its indexes
+    """
+    records = [{"country": f"c{index % 200}", "amount": index % 1000, "user": f"u{index}"} for index in range(size)]
+    dataset = Dataset(records)
+
+    for input_string in ["S$user==u42", "S$country==c7&&F$amount>=500", "F$amount>=990||S$user==u42",
+                         "!!S$country==c7"]:
+        expression = StringBooleanExpression(input_string)
+        start = time.perf_counter()
+        expected = [position for position, record in enumerate(records) if expression.check(record)]
+        check_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert dataset.query(expression) == expected
+        first_time = time.perf_counter() - start
+        query_time = best_time_per_call(lambda: dataset.query(expression), number=1, repeat=3) / 1e9
+        print(f"{size} records  {input_string:<30} check {check_time:6.3f} s  first query {first_time:6.3f} s  "
+              f"query {query_time:8.5f} s  speedup {check_time / query_time:7.1f}x")
+
+
+def benchmark_load_rules(size: int = 50000) -> None:
+    """
+    Compares loading a rules file by parsing every rule with loading it from its cache file
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rules.txt")
+        with open(path, "w") as rules_file:
+            for index in range(size):
+                rules_file.write(f"S$country==c{index % 200}&&F$amount>={index % 1000}||S$user==u{index}\n")
+
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            load_rules(path)
+            timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with open(path + RULE_CACHE_SUFFIX, "rb") as cache_file:
+            cache_file.read()
+        read_time = time.perf_counter() - start
+
+    print(f"{size} rules  parse {timings[0]:6.2f} s  from cache {timings[1]:6.2f} s  "
+          f"(reading the cache file alone {read_time:6.3f} s)")
+
+
+def benchmark_simplify(size: int = 20000) -> None:
+    """
+    Compares checking every rule of a rules file that has each rule written in four ways with checking only the
+    distinct simplified rules
+    """
+    lines = []
+    for index in range(size // 4):
+        country, amount = f"c{index % 200}", index
+        lines += [f"S$country=={country}&&F$amount>={amount}", f"{amount}<=F$amount&&{country}==S$country",
+                  f"S$country=={country}&&(F$amount>={amount}||F$amount>>{amount + 5})",
+                  f"S$country=={country}&&F$amount>={amount}&&F$amount>={amount - 10}"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rules.txt")
+        with open(path, "w") as rules_file:
+            rules_file.write("\n".join(lines))
+        start = time.perf_counter()
+        duplicates = find_duplicate_rules(path)
+        find_time = time.perf_counter() - start
+
+    expressions = [StringBooleanExpression(line) for line in lines]
+    start = time.perf_counter()
+    simplified = list(set(expression.simplify() for expression in expressions))
+    simplify_time = time.perf_counter() - start
+
+    record = {"country": "c7", "amount": 120.0}
+    assert sum(expression.check(record) for expression in expressions) == \
+        4 * sum(expression.check(record) for expression in simplified)
+    check_time = best_time_per_call(lambda: [expression.check(record) for expression in expressions], number=5)
+    simplified_time = best_time_per_call(lambda: [expression.check(record) for expression in simplified], number=5)
+    print(f"{size} rules  {len(duplicates)} groups of duplicates found in {find_time:5.2f} s  "
+          f"{len(simplified)} distinct rules after simplifying in {simplify_time:5.2f} s")
+    print(f"{size} rules  check every rule {check_time / 1e6:8.2f} ms  check distinct rules "
+          f"{simplified_time / 1e6:8.2f} ms  speedup {check_time / simplified_time:5.1f}x")
+
+
+def benchmark_parallel(size: int = 200000) -> None:
+    """
+    Shows how counting the matches of JSON lines scales from one process to every core
+    """
+    expression = StringBooleanExpression("S$country==c7&&F$amount>=500||S$user==u42")
+    lines = [json.dumps({"country": f"c{index % 200}", "amount": index % 1000, "user": f"u{index}"}) + "\n"
+             for index in range(size)]
+
+    start = time.perf_counter()
+    expected = sum(1 for _ in filter_jsonl(expression, lines))
+    sequential_time = time.perf_counter() - start
+    print(f"{size} lines  sequential {sequential_time:6.2f} s")
+
+    for processes in range(1, (os.cpu_count() or 1) + 1):
+        start = time.perf_counter()
+        count = count_parallel(expression, lines, processes=processes, record_format="jsonl")
+        parallel_time = time.perf_counter() - start
+        assert count == expected
+        print(f"{processes:>3} processes  {parallel_time:6.2f} s  speedup {sequential_time / parallel_time:5.2f}x")
+
+
+def run_comparisons() -> None:
+    """
+    Runs every comparison benchmark
+    """
+    benchmark_constant_folding()
+    benchmark_bind()
+    benchmark_instrumentation()
+    benchmark_adaptive_ordering()
+    benchmark_construction()
+    benchmark_rule_set()
+    benchmark_incremental()
+    benchmark_sqlite()
+    benchmark_dataset()
+    benchmark_load_rules()
+    benchmark_simplify()
+    benchmark_parallel()
+
+
+def measure(function, items: int = 1, samples: int = 30, min_sample_time: float = 0.002) -> dict:
+    """
+    Measures a function. The function is called enough times per sample that each sample takes at least
+    min_sample_time, so the latency of fast functions is not lost in the resolution of the clock. Garbage collection
+    is disabled while timing, the same as timeit. The peak memory is measured with tracemalloc in a separate call, so
+    tracing does not slow down the timed calls.
+    :param function: The function to measure, called without arguments
+    :param items: How many items one call processes, the throughput and latencies are per item
+    :param samples: The number of samples the latency percentiles are taken from
+    :param min_sample_time: The minimum time of one sample in seconds
+    :return: The throughput in items per second, the latency percentiles per item in nanoseconds and the peak memory
+             allocated during one call in bytes
+    """
+    calls = 1
+    while _time_calls(function, calls) < min_sample_time:
+        calls *= 2
+
+    timings = sorted(_time_calls(function, calls) for _ in range(samples))
+    latencies = [timing / (calls * items) * 1e9 for timing in timings]
+
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "items_per_second": samples * calls * items / sum(timings),
+        "latency_ns": {"min": latencies[0], "p50": percentile(latencies, 50), "p90": percentile(latencies, 90),
+                       "p99": percentile(latencies, 99), "max": latencies[-1]},
+        "peak_memory_bytes": peak_memory,
+        "calls_per_sample": calls,
+    }
+
+
+def _time_calls(function, calls: int) -> float:
+    """
+    :return: The time in seconds it takes to call the function the number of times
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """
+    :return: The nearest rank percentile of the already sorted values
+    """
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def sized_expression(size: int) -> str:
+    """
+    :return: An expression with size pairs of comparisons on two variables
+    """
+    return "||".join(f"(S$name==name{index}&&F$salary>={index}.5)" for index in range(size))
+
+
+def nested_expression(depth: int) -> str:
+    """
+    :return: An expression where every comparison is nested one group deeper than the one before it, alternating
+             between && and ||
+    """
+    expression = "S$name==bob"
+    for index in range(depth):
+        expression = f"(I$level{index % 10}>={index}{'&&' if index % 2 else '||'}{expression})"
+    return expression
+
+
+def many_variables_expression(count: int) -> str:
+    """
+    :return: An expression that compares count different variables
+    """
+    return "&&".join(f"I$field{index}>={index}" for index in range(count))
+
+
+def suite_cases(quick: bool = False):
+    """
+    Yields the name of the stage, the name of the case, the function to measure and the number of items one call
+    processes for every measurement of the suite. Every input is generated without randomness so runs are comparable.
+    :param quick: If True the largest cases are left out
+    """
+    expressions = [(f"size_{size}", sized_expression(size)) for size in [1, 10, 100] + ([] if quick else [1000])]
+    expressions += [(f"depth_{depth}", nested_expression(depth)) for depth in [10, 50] + ([] if quick else [100])]
+    expressions += [(f"variables_{count}", many_variables_expression(count))
+                    for count in [10, 100] + ([] if quick else [1000])]
+
+    for case, input_string in expressions:
+        tree, variables = StringBooleanExpression._parse_input(input_string, {"EMPTY_STRING": ""})
+        sorted_variables = sorted(variables)
+        expression = StringBooleanExpression(input_string)
+        # Every variable is present, and the value makes every size and variables comparison run before the result
+        # is known
+        record = {variable: "1000000" for variable in sorted_variables}
+
+        yield "_check_for_invalid", case, lambda: StringBooleanExpression._check_for_invalid(input_string), 1
+        yield ("_parse_input", case,
+               lambda: StringBooleanExpression._parse_input(input_string, {"EMPTY_STRING": ""}), 1)
+        yield ("_set_up_function", case,
+               lambda: StringBooleanExpression._set_up_function(tree, sorted_variables), 1)
+        yield "check", case, lambda: expression.check(record), 1
+
+    expression = StringBooleanExpression(COMPLEX_EXAMPLE)
+    for size in [1000, 100000] + ([] if quick else [1000000]):
+        # Cycles through records that resolve the expression at different points, with some missing a field
+        records = [dict(RECORDS[index % len(RECORDS)]) for index in range(size)]
+        for record in records[::7]:
+            del record["salary"]
+
+        yield "check", f"records_{size}", lambda: [expression.check(record) for record in records], size
+        yield "check_many", f"records_{size}", lambda: expression.check_many(records), size
+
+
+def run_suite(quick: bool = False) -> dict:
+    """
+    Runs every measurement of the suite and prints a line for each
+    :param quick: If True the largest cases are left out
+    :return: The results with the environment they were measured in, ready to be written as JSON
+    """
+    results = {}
+    for stage, case, function, items in suite_cases(quick):
+        samples = 30 if items == 1 else 5
+        result = measure(function, items, samples=samples)
+        results[f"{stage}/{case}"] = result
+        print(f"{stage:<20} {case:<18} {result['items_per_second']:>14,.0f} items/s  "
+              f"p50 {result['latency_ns']['p50']:>12,.0f} ns  p99 {result['latency_ns']['p99']:>12,.0f} ns  "
+              f"peak {result['peak_memory_bytes']:>12,} B", file=sys.stderr)
+
+    return {"environment": environment(), "results": results}
+
+
+def environment() -> dict:
+    """
+    :return: What the results depend on besides the code, and the commit of the code when run in a git checkout
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    numpy = stringbooleanexpression.numpy
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy.__version__ if numpy is not None else None,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.25) -> int:
+    """
+    Prints how the median latency of every measurement changed between two suite results
+    :param baseline: The results to compare against
+    :param current: The new results
+    :param threshold: The fraction the median latency has to grow by to count as a regression
+    :return: The number of regressions
+    """
+    regressions = 0
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:<40} new")
+            continue
+
+        ratio = result["latency_ns"]["p50"] / baseline["results"][name]["latency_ns"]["p50"]
+        memory_ratio = (result["peak_memory_bytes"] + 1) / (baseline["results"][name]["peak_memory_bytes"] + 1)
+        regressed = ratio > 1 + threshold
+        regressions += regressed
+        print(f"{name:<40} p50 {ratio:6.2f}x  peak memory {memory_ratio:6.2f}x{'  REGRESSION' if regressed else ''}")
+
+    for environment_key in ["python", "platform", "numpy"]:
+        if baseline["environment"].get(environment_key) != current["environment"].get(environment_key):
+            print(f"Warning: the {environment_key} differs, {baseline['environment'].get(environment_key)} against "
+                  f"{current['environment'].get(environment_key)}")
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("comparisons", help="Print the comparison benchmarks, the default")
+    suite = commands.add_parser("suite", help="Measure every stage and write the results as JSON")
+    suite.add_argument("-o", "--output", help="The file to write the JSON to, stdout by default")
+    suite.add_argument("--quick", action="store_true", help="Leave out the largest cases")
+    comparison = commands.add_parser("compare", help="Compare two JSON results from suite")
+    comparison.add_argument("baseline")
+    comparison.add_argument("current")
+    comparison.add_argument("--threshold", type=float, default=0.25,
+                            help="The fraction the median latency has to grow by to count as a regression")
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "suite":
+        output = json.dumps(run_suite(arguments.quick), indent=2)
+        if arguments.output is None:
+            print(output)
+        else:
+            with open(arguments.output, "w") as output_file:
+                output_file.write(output + "\n")
+        return 0
+
+    if arguments.command == "compare":
+        with open(arguments.baseline) as baseline_file, open(arguments.current) as current_file:
+            regressions = compare(json.load(baseline_file), json.load(current_file), arguments.threshold)
+        return 1 if regressions else 0
+
+    run_comparisons()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -29,6 +29,31 @@ Limitations:
 In the event of a invalid string being found in the input_string a ValueError is raised.
 
 """
+import argparse
+import ast
+import bisect
+import contextlib
+import csv
+import hashlib
+import itertools
+import json
+import marshal
+import multiprocessing
+import operator
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter, OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Variable replacement
 VARIABLE_START = "$"
@@ -36,6 +61,9 @@ FLOAT = ("F", "float")
 INTEGER = ("I", "int")
 STRING = ("S", "str")
 
+# Maps the resolved type name to the cast that is used for it
+CASTS = {FLOAT[1]: float, INTEGER[1]: int, STRING[1]: str}
+
 # Operator
 AND_OP = ("&&", " and ")
 OR_OP = ("||", " or ")
@@ -55,6 +83,55 @@ COMPARISONS = [
     (">=", " >= ")  # Greater Than or Equal
 ]
 
+# Maps each comparison to the ast operator that it compiles to
+_COMPARISON_OPERATORS = {comparison[0]: type(ast.parse("a" + comparison[1] + "a", mode="eval").body.ops[0])
+                         for comparison in COMPARISONS}
+
+# Maps each comparison operator to its token and to the operator that is equivalent when the operands are swapped
+_OPERATOR_TOKENS = {operator: token for token, operator in _COMPARISON_OPERATORS.items()}
+_SWAPPED_OPERATORS = {ast.Eq: ast.Eq, ast.NotEq: ast.NotEq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt,
+                      ast.GtE: ast.LtE}
+
+# Maps each comparison operator to the operator of its negation, and to the function that evaluates it
+_NEGATED_OPERATORS = {ast.Eq: ast.NotEq, ast.NotEq: ast.Eq, ast.Lt: ast.GtE, ast.LtE: ast.Gt, ast.Gt: ast.LtE,
+                      ast.GtE: ast.Lt}
+_OPERATOR_FUNCTIONS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                       ast.Gt: operator.gt, ast.GtE: operator.ge}
+_LOWER_BOUNDS = {ast.Gt, ast.GtE}
+_UPPER_BOUNDS = {ast.Lt, ast.LtE}
+
+# Splits an input string into operands and the operator, comparison and grouping tokens between them
+_TOKEN_PATTERN = re.compile("(" + "|".join(re.escape(token) for token in [AND_OP[0], OR_OP[0], NOT_OP[0]] +
+                                           list(_COMPARISON_OPERATORS) + [GROUP_OPEN, GROUP_CLOSE]) + ")")
+
+# The Python types whose values compare the same in a NumPy array as after the cast of each type, and the kinds of
+# NumPy arrays that do, see _vectorized_column
+_VECTORIZED_TYPES = {FLOAT[1]: (float, int), INTEGER[1]: (int,), STRING[1]: (str,)}
+_VECTORIZED_KINDS = {FLOAT[1]: "fiu", INTEGER[1]: "iu", STRING[1]: "U"}
+
+# Maps each comparison to its SQL operator, and each type to the SQL type it is cast to and the column affinities
+# that guarantee the storage class of the type, see to_sql. A REAL or INTEGER column still stores text that does not
+# look like a number as TEXT, and an INTEGER column stores numbers that are not whole as REAL, so only TEXT columns
+# guarantee the storage class of their type
+_SQL_OPERATORS = {"!=": "<>", "==": "=", "<<": "<", "<=": "<=", ">>": ">", ">=": ">="}
+_SQL_TYPES = {FLOAT[1]: "REAL", INTEGER[1]: "INTEGER", STRING[1]: "TEXT"}
+_SQL_NATIVE_AFFINITIES = {FLOAT[1]: set(), INTEGER[1]: set(), STRING[1]: {"TEXT"}}
+# The column affinities that store numbers as INTEGER or REAL, a float comparison of such a column is made on the
+# column itself and guarded by its storage class, so an index on the column is still usable
+_SQL_NUMERIC_AFFINITIES = {"INTEGER", "REAL", "NUMERIC"}
+
+# Token kinds for operands and comparisons, the other tokens use their own text as the kind
+_OPERAND = "operand"
+_COMPARISON = "comparison"
+
+# The most groups and not operators that can be nested in an input string, deeper trees would exceed the recursion
+# limit while they are parsed, compiled or simplified
+MAX_NESTING = 100
+
+# Maps the type prefix of a variable to the resolved type name and back
+_TYPES = {STRING[0]: STRING[1], FLOAT[0]: FLOAT[1], INTEGER[0]: INTEGER[1]}
+_TYPE_PREFIXES = {STRING[1]: STRING[0], FLOAT[1]: FLOAT[0], INTEGER[1]: INTEGER[0]}
+
 # Illegal characters and phrases that will cause ValueError exception to be thrown
 ILLEGAL_STRINGS = ["import ", "eval", "\n", "\r", "\"", "\'",
                    "lambda", " if ", " else ", "for ", "def ",
@@ -63,8 +140,150 @@ ILLEGAL_STRINGS = ["import ", "eval", "\n", "\r", "\"", "\'",
 # Used to wrap internal variables so they are unique
 INTERNAL_VARIABLE_WRAP_CHAR = "__E__"
 
+# The only names available to the compiled commands
+_COMMAND_GLOBALS = {"__builtins__": {}, **CASTS}
+# The functions returned by bind also check the length of the row
+_BOUND_GLOBALS = {**_COMMAND_GLOBALS, "len": len}
+
+# Every generated ast node is placed at the start of the first line, there is no source to point to
+_LOCATION = {"lineno": 1, "col_offset": 0}
+
+# Used to mark a field that is not present in a record
+_MISSING = object()
+
+# The keywords used when no keyword_value_mapping is passed in
+DEFAULT_KEYWORD_VALUE_MAPPING = {"EMPTY_STRING": ""}
+
+# Added to the path of a rules file to get the path of its cache file, see load_rules
+RULE_CACHE_SUFFIX = ".cache"
+
+# Part of the key of a rule cache file, it needs to be increased whenever the content of the cache file changes
+_RULE_CACHE_VERSION = 2
+
+# The name of the argument holding the set of true predicate indexes in the functions compiled by RuleSet
+_TRUE_PREDICATES = "true_predicates"
+
+# Statistics reported by ExpressionCache.stats
+CacheStats = namedtuple("CacheStats", ["hits", "misses", "evictions", "size", "max_size"])
+
+# Statistics reported by StringBooleanExpression.stats, total_time is in seconds
+EvaluationStats = namedtuple("EvaluationStats", ["evaluations", "total_time", "missing_fields", "comparisons"])
+ComparisonStats = namedtuple("ComparisonStats", ["comparison", "true_count", "false_count"])
+
+# Dataset only intersects the rows of an && operand with the rows of the smallest operand when it has at most this many
+# times as many rows
+_INTERSECTION_RATIO = 4
+
+# Simplification compares every pair of operands of an && or ||, so larger groups only have their comparisons merged
+_ABSORPTION_LIMIT = 100
+
+# The name of the function that counts the results of nodes in the commands compiled by enable_instrumentation and
+# enable_adaptive_ordering
+_PROBE = "probe"
+
+# The name of the command that the reordered command of enable_adaptive_ordering falls back to when a cast raises
+_FALLBACK = "fallback"
+
+
+class ExpressionCache:
+    """
+    A thread safe, bounded, least recently used cache of StringBooleanExpression instances.
+    The entries are keyed on the input string together with the keyword value mapping. The input string is used
+    as is, since whitespace is part of constant values.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """
+        :param max_size: The most expressions to hold before the least recently used is evicted, 0 disables caching
+        """
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self.max_size = max_size
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size: int) -> None:
+        """
+        Lowering the max size evicts the least recently used expressions until the cache fits
+        """
+        if max_size < 0:
+            raise ValueError(f"The max size of the cache can not be negative: {max_size}")
+
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+
+    def get(self, input_string: str, keyword_value_mapping=None) -> "StringBooleanExpression":
+        """
+        NOTE: This can raise a ValueError in the event that the input_string was invalid.
+
+        Returns the cached expression or compiles and caches a new one.
+        :param input_string: The same as StringBooleanExpression
+        :param keyword_value_mapping: The same as StringBooleanExpression
+        :return: The expression, which is shared with every other caller that used the same arguments
+        """
+        if keyword_value_mapping is None:
+            keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
+        key = (input_string, frozenset(keyword_value_mapping.items()))
+
+        with self._lock:
+            expression = self._entries.get(key)
+            if expression is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return expression
+            self._misses += 1
+
+        # Compiled outside of the lock so a slow compile does not block cache hits
+        expression = StringBooleanExpression(input_string, keyword_value_mapping)
+
+        with self._lock:
+            # Nothing is inserted when caching is disabled, so it is not counted as an eviction
+            if self._max_size:
+                self._entries[key] = expression
+                self._evict()
+        return expression
+
+    def stats(self) -> CacheStats:
+        """
+        :return: The hit, miss and eviction counts since the cache was created or last cleared
+        """
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._max_size)
+
+    def clear(self) -> None:
+        """
+        Removes every expression from the cache and resets the statistics
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self) -> None:
+        """
+        Removes the least recently used expressions until the cache fits, the lock must be held
+        """
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
 
 class StringBooleanExpression:
+    # The cache used by compile
+    compile_cache = ExpressionCache()
+
     def __init__(self, input_string: str, keyword_value_mapping=None):
         """
         NOTE: This can raise a ValueError in the event that the input_string was invalid.
@@ -81,13 +300,120 @@ class StringBooleanExpression:
                                       By default, there is EMPTY_STRING=""
         """
         if keyword_value_mapping is None:
-            keyword_value_mapping = {"EMPTY_STRING": ""}
+            keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
 
         self._check_for_invalid(input_string)
-        self._command_string, self._variables = self._parse_input(input_string, keyword_value_mapping)
+        tree, variables = self._parse_input(input_string, keyword_value_mapping)
+        self._set_up(input_string, keyword_value_mapping, tree, sorted(variables))
+
+    def _set_up(self, input_string: str, keyword_value_mapping: dict, tree, sorted_variables: list,
+                command=None) -> None:
+        """
+        Sets up the expression from an already parsed tree
+        :param input_string: The input string the tree was parsed from
+        :param keyword_value_mapping: The keyword mapping the tree was parsed with
+        :param tree: The parsed expression tree, or its serialized form which is only deserialized when needed
+        :param sorted_variables: The variables of the tree in sorted order
+        :param command: The already compiled command for the tree, it is compiled when None
+        """
+        self._input_string = input_string
+        self._keyword_value_mapping = keyword_value_mapping
+        self._lazy_tree = tree
+        self._variables = set(sorted_variables)
+
+        self._sorted_variables = list(sorted_variables)
+        self._command = command if command is not None else self._set_up_function(self._tree, self._sorted_variables)
+
+        # Only built on the first call to check_many when NumPy is available
+        self._vectorized_command = None
+        self._vectorized_variables = None
+
+        # Only set while instrumentation or adaptive ordering is enabled
+        self._instrumentation = None
+        self._adaptive_ordering = None
+
+        # Only built when the expression is first compared or hashed
+        self._canonical_tree = None
+
+    @property
+    def _tree(self) -> "Node":
+        """
+        :return: The parsed expression tree
+        """
+        if isinstance(self._lazy_tree, tuple):
+            self._lazy_tree = Node.deserialize(self._lazy_tree)
+        return self._lazy_tree
 
-        self._sorted_variables = sorted(self._variables)
-        self._command = self._set_up_function(self._command_string, self._sorted_variables)
+    def serialize(self) -> tuple:
+        """
+        The serialized form holds the parsed expression tree, so deserialize does not need to parse the input string
+        again. It is made only of tuples, strings and numbers, so it can be stored with pickle, marshal or json.
+        :return: A tuple of the input string, the keyword mapping items, the sorted variables and the serialized
+                 expression tree
+        """
+        tree = self._lazy_tree if isinstance(self._lazy_tree, tuple) else self._lazy_tree.serialize()
+        return (self._input_string, tuple(self._keyword_value_mapping.items()), tuple(self._sorted_variables),
+                tree)
+
+    @classmethod
+    def deserialize(cls, data, command=None) -> "StringBooleanExpression":
+        """
+        :param data: The output of serialize
+        :param command: The already compiled command, it is compiled when None
+        :return: The expression
+        """
+        input_string, keyword_value_items, sorted_variables, tree = data
+        expression = cls.__new__(cls)
+        expression._set_up(input_string, dict(keyword_value_items), tree, sorted_variables, command)
+        return expression
+
+    def __getstate__(self) -> tuple:
+        # The compiled command can not be pickled, so only the serialized form is
+        return self.serialize()
+
+    def __setstate__(self, state: tuple) -> None:
+        input_string, keyword_value_items, sorted_variables, tree = state
+        self._set_up(input_string, dict(keyword_value_items), tree, sorted_variables)
+
+    @classmethod
+    def compile(cls, input_string: str, keyword_value_mapping=None) -> "StringBooleanExpression":
+        """
+        NOTE: This can raise a ValueError in the event that the input_string was invalid.
+
+        Returns an expression from compile_cache, so repeated input strings are only parsed and compiled once.
+        The returned expression is shared between callers.
+        :param input_string: The same as the constructor
+        :param keyword_value_mapping: The same as the constructor
+        :return: The compiled expression
+        """
+        return cls.compile_cache.get(input_string, keyword_value_mapping)
+
+    def simplify(self) -> "StringBooleanExpression":
+        """
+        Builds an expression from the simplified tree, see Node.simplified. The new expression keeps the input string
+        and the fields of this one, so a record that is missing a field the simplified tree no longer uses still
+        resolves to False.
+        :return: The simplified expression
+        """
+        expression = type(self).__new__(type(self))
+        expression._set_up(self._input_string, self._keyword_value_mapping, self._tree.simplified(),
+                           self._sorted_variables)
+        return expression
+
+    def _canonical(self) -> tuple:
+        """
+        :return: The fields and canonical tree of the expression, see Node.canonical
+        """
+        if self._canonical_tree is None:
+            self._canonical_tree = self._tree.canonical()
+        return tuple(self._sorted_variables), self._canonical_tree
+
+    def __eq__(self, other) -> bool:
+        # Expressions are equal when they use the same fields and their canonical trees are equal
+        return isinstance(other, StringBooleanExpression) and self._canonical() == other._canonical()
+
+    def __hash__(self) -> int:
+        return hash(self._canonical())
 
     def check(self, input_dict: dict) -> bool:
         """
@@ -101,189 +427,400 @@ class StringBooleanExpression:
         else:
             return False
 
+    def bind(self, schema, strict: bool = False):
+        """
+        Specializes the expression to rows that are sequences with the fields in a fixed order, for example tuples
+        from a database cursor or lists from a csv.reader. The returned function reads the positions it needs straight
+        from the row, so no dictionary is built per row.
+        A field of the expression that is not in the schema is missing from every row, and a row that is shorter than
+        the schema is missing the fields past its end. Missing fields resolve to False, the same as check.
+        :param schema: The field names in the order they appear in each row
+        :param strict: If True a field missing from the schema raises a ValueError here and the length of the rows
+                       is not checked, so reading a field past the end of a row raises an IndexError
+        :return: A function that takes a row and returns if the expression resolves to True
+        """
+        positions = {}
+        for position, field in enumerate(schema):
+            positions.setdefault(field, position)
+
+        missing = sorted(self._variables.difference(positions))
+        if missing:
+            if strict:
+                raise ValueError(f"The schema is missing the fields {missing}.")
+            return lambda row: False
+
+        row = "row"
+        statements, references = self._hoist_casts(
+            self._tree, lambda name: _subscript(ast.Name(id=row, ctx=ast.Load(), **_LOCATION), positions[name]),
+            lambda name, variable_type: INTERNAL_VARIABLE_WRAP_CHAR + name + INTERNAL_VARIABLE_WRAP_CHAR + variable_type)
+
+        if not strict and self._variables:
+            # if len(row) <= last: return False
+            last = max(positions[variable] for variable in self._variables)
+            length = ast.Call(func=ast.Name(id="len", ctx=ast.Load(), **_LOCATION),
+                              args=[ast.Name(id=row, ctx=ast.Load(), **_LOCATION)], keywords=[], **_LOCATION)
+            too_short = ast.Compare(left=length, ops=[ast.LtE()], comparators=[ast.Constant(value=last, **_LOCATION)],
+                                    **_LOCATION)
+            statements.insert(0, ast.If(test=too_short, orelse=[], **_LOCATION,
+                                        body=[ast.Return(value=ast.Constant(value=False, **_LOCATION), **_LOCATION)]))
+
+        return _build_function([row], statements, self._tree.to_python(references), name="bound",
+                               namespace=_BOUND_GLOBALS)
+
+    def to_sql(self, column_affinities: Mapping = None) -> (str, list):
+        """
+        Translates the expression into a SQLite WHERE clause with ? parameters, so a database can do the filtering.
+        Every field is a column of the same name, and a NULL column is treated like a missing field, so the row does
+        not match. Columns are cast to the SQL type of the variable type, and a comparison of a cast column can not
+        use an index on it. Two cases are not cast, so indexes on them stay usable:
+        - TEXT columns compared as strings, the affinity guarantees their values are TEXT
+        - INTEGER, REAL and NUMERIC columns compared as floats, the comparison is only True for the values that are
+          stored as INTEGER or REAL, for example "salary" > ? AND typeof("salary") IN ('integer', 'real')
+        Int comparisons are always cast, since an INTEGER column stores numbers that are not whole as REAL and the
+        cast truncates them.
+        SQLite casts values that do not fit a type instead of raising like check does, for example CAST('abc' AS REAL)
+        is 0.0, so rows with such values can match differently.
+        :param column_affinities: Maps a column name to its SQLite affinity, TEXT, NUMERIC, INTEGER, REAL or BLOB, see
+                                  _sqlite_affinity. Columns that are not in it are always cast
+        :return: The WHERE clause without the WHERE keyword, and the list of parameter values in order
+        """
+        column_affinities = column_affinities or {}
+
+        def reference(name: str, variable_type: str) -> (str, str):
+            column = _quote_identifier(name)
+            affinity = column_affinities.get(name)
+            if affinity in _SQL_NATIVE_AFFINITIES[variable_type]:
+                return column, None
+            if variable_type == FLOAT[1] and affinity in _SQL_NUMERIC_AFFINITIES:
+                return column, f"typeof({column}) IN ('integer', 'real')"
+            return f"CAST({column} AS {_SQL_TYPES[variable_type]})", None
+
+        parameters = []
+        condition = self._tree.to_sql(reference, parameters)
+        guards = [f"{_quote_identifier(variable)} IS NOT NULL" for variable in self._sorted_variables]
+        return " AND ".join(guards + [condition]), parameters
+
+    def enable_instrumentation(self) -> None:
+        """
+        Starts recording how the expression is evaluated by check, see stats. While enabled check calls a second
+        command that counts the result of every comparison it runs, comparisons that are skipped because the result of
+        an && or || is already known are not counted. Disabling removes it again, so check has no added cost when
+        instrumentation is not enabled. Expressions from compile are shared, so their statistics are too.
+        """
+        if self._instrumentation is None:
+            self._instrumentation = _Instrumentation(self._tree, self._sorted_variables)
+            # The instance attribute hides the method of the class until it is deleted
+            self.check = self._instrumented_check
+
+    def disable_instrumentation(self) -> None:
+        """
+        Stops recording and drops the recorded statistics
+        """
+        if self._instrumentation is not None:
+            self._instrumentation = None
+            del self.check
+
+    def stats(self) -> EvaluationStats:
+        """
+        NOTE: This raises a ValueError if instrumentation is not enabled.
+
+        :return: The statistics recorded since instrumentation was enabled or last reset. The comparisons are in
+                 the order they appear in the input string, with the number of times each was true and false
+        """
+        instrumentation = self._instrumentation
+        if instrumentation is None:
+            raise ValueError("Instrumentation is not enabled, call enable_instrumentation first.")
+        comparisons = [ComparisonStats(str(comparison), counts[True], counts[False])
+                       for comparison, counts in zip(instrumentation.comparisons, instrumentation.counts)]
+        return EvaluationStats(instrumentation.evaluations, instrumentation.total_time, instrumentation.missing_fields,
+                               comparisons)
+
+    def reset_stats(self) -> None:
+        """
+        Sets the recorded statistics back to zero, does nothing if instrumentation is not enabled
+        """
+        if self._instrumentation is not None:
+            self._instrumentation.reset()
+
+    def enable_adaptive_ordering(self, sample_size: int = 1000) -> None:
+        """
+        Starts sampling how often each operand of every && and || decides the result, and after sample_size
+        evaluations recompiles the command with the operands reordered. Operands that are cheap and likely to decide
+        the result come first, so short circuiting skips more of the expression, including the casts of the skipped
+        comparisons. The operands of && and || commute, so every record that check resolves gets the same result.
+        If the reordered command raises, the original command is called instead, so the same exception is raised.
+        A record with a field that can not be cast can still resolve when the reordered command never reaches that
+        field, where the original order would have raised.
+        Expressions from compile are shared, so the ordering is too.
+        :param sample_size: The number of evaluations to sample before reordering
+        """
+        if sample_size < 1:
+            raise ValueError(f"The sample size must be at least 1, got {sample_size}.")
+        self.disable_adaptive_ordering()
+        self._adaptive_ordering = _AdaptiveOrdering(self, sample_size)
+        self._command = self._adaptive_ordering.sampling_command
+
+    def disable_adaptive_ordering(self) -> None:
+        """
+        Stops sampling and restores the command in the order of the input string
+        """
+        if self._adaptive_ordering is not None:
+            self._command = self._adaptive_ordering.original_command
+            self._adaptive_ordering = None
+
+    def _instrumented_check(self, input_dict: dict) -> bool:
+        """
+        The same as check, while recording the statistics of the evaluation
+        """
+        instrumentation = self._instrumentation
+        start = time.perf_counter()
+        if all(variable in input_dict for variable in self._sorted_variables):
+            result = instrumentation.command(*[input_dict[item] for item in self._sorted_variables])
+        else:
+            instrumentation.missing_fields += 1
+            result = False
+        instrumentation.total_time += time.perf_counter() - start
+        instrumentation.evaluations += 1
+        return result
+
+    def check_many(self, records):
+        """
+        Evaluates the expression against many records at once.
+        The records can either be a sequence of dictionaries or a mapping of field name to column (a list or a
+        NumPy array), where every column has the same length.
+        A record that is missing any of the expression fields resolves to False, the same as check. For the columnar
+        form a missing column means every row resolves to False.
+        When NumPy is installed a NumPy boolean array is returned, otherwise the rows are evaluated in a single pass and
+        a list of bools is returned. The comparisons and operators are run as vectorized array operations when every
+        column already holds values of the type it is compared as, otherwise the rows are checked one by one, so the
+        results and errors are the same as check.
+        :param records: A sequence of dictionaries or a mapping of field name to column
+        :return: A boolean mask with one entry per record
+        """
+        if isinstance(records, Mapping):
+            length = self._column_length(records)
+            if any(variable not in records for variable in self._sorted_variables):
+                return numpy.zeros(length, dtype=bool) if numpy is not None else [False] * length
+            columns = [records[variable] for variable in self._sorted_variables]
+            present = None
+        else:
+            length = len(records)
+            columns = [[record.get(variable, _MISSING) for record in records] for variable in self._sorted_variables]
+            present = [all(value is not _MISSING for value in row) for row in zip(*columns)]
+            if all(present):
+                present = None
+
+        if numpy is None:
+            if present is None:
+                return [self._command(*row) for row in zip(*columns)]
+            return [is_present and self._command(*row) for is_present, row in zip(present, zip(*columns))]
+
+        if self._vectorized_command is None:
+            self._vectorized_command, self._vectorized_variables = self._set_up_vectorized_function(self._tree)
+
+        result = numpy.zeros(length, dtype=bool)
+        if present is None:
+            selected = slice(None)
+        else:
+            selected = numpy.asarray(present, dtype=bool)
+            columns = [list(itertools.compress(column, present)) for column in columns]
+
+        arrays = dict(zip(self._sorted_variables, columns))
+        arguments = [self._vectorized_column(arrays[variable], variable_type)
+                     for variable, variable_type in self._vectorized_variables]
+        if any(argument is None for argument in arguments):
+            # Casting can raise or short circuit like in check, so the rows are checked one by one
+            result[selected] = [self._command(*row) for row in zip(*columns)]
+        else:
+            result[selected] = self._vectorized_command(*arguments)
+        return result
+
+    @staticmethod
+    def _vectorized_column(column, variable_type: str):
+        """
+        NumPy converts values with its own rules, which differ from the casts, for example 1 in a column with 2.5 is
+        1.0 and str(1) is "1", so only columns that need no cast are vectorized
+        :param column: A list or NumPy array with the values of a field
+        :param variable_type: The type the field is compared as, index one from STRING, FLOAT or INTEGER
+        :return: An array that compares the same as the cast values, or None if a value needs to be cast
+        """
+        if isinstance(column, numpy.ndarray) and column.dtype != object:
+            if column.dtype.kind not in _VECTORIZED_KINDS[variable_type]:
+                return None
+            # float64 compares like a Python float, and object arrays compare with the Python operators, so a large
+            # integer constant or one with a trailing NUL is not converted to the type of the array
+            return column.astype(float if variable_type == FLOAT[1] else object)
+
+        types = _VECTORIZED_TYPES[variable_type]
+        if not all(type(value) in types for value in column):
+            return None
+        if variable_type == FLOAT[1]:
+            return numpy.asarray(column, dtype=float)
+        array = numpy.empty(len(column), dtype=object)
+        array[:] = column
+        return array
+
+    @staticmethod
+    def _column_length(columns: Mapping) -> int:
+        """
+        Finds the shared length of the columns in a columnar batch
+        :param columns: A mapping of field name to column
+        :return: The number of rows, or zero if there are no columns
+        """
+        lengths = {len(column) for column in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns must all have the same length, found lengths {sorted(lengths)}")
+        return lengths.pop() if lengths else 0
+
     @staticmethod
-    def _set_up_function(command_string: str, sorted_variables: list, variable_wrap: str = INTERNAL_VARIABLE_WRAP_CHAR):
+    def _set_up_function(tree: "Node", sorted_variables: list, variable_wrap: str = INTERNAL_VARIABLE_WRAP_CHAR,
+                         namespace: dict = _COMMAND_GLOBALS, fallback=None):
         """
-        This handles actually creating the command to run given a parsed command string and the sorted variables
-        :param command_string: The parsed command string with the variables cast/replaced, and operators adjusted
+        This handles actually creating the command to run given a parsed expression tree and the sorted variables.
+        A variable that is cast to the same type more than once in the expression is only cast once per call.
+        :param tree: The parsed expression tree
         :param sorted_variables: The variables in their expected order
         :param variable_wrap: The string to wrap the variable in
-        :return: An evaluated expression that can be called given valid input
+        :param namespace: The globals of the command
+        :param fallback: If given and the command raises an exception, the fallback is called with the same arguments
+                         and its result is returned instead
+        :return: A compiled function that can be called given valid input
         """
+        parameters = {item: variable_wrap + item + variable_wrap for item in sorted_variables}
+        statements, references = StringBooleanExpression._hoist_casts(
+            tree, lambda name: ast.Name(id=parameters[name], ctx=ast.Load(), **_LOCATION),
+            lambda name, variable_type: parameters[name] + variable_type)
+        expression = tree.to_python(references)
 
-        input_sequence = ", ".join([variable_wrap + item + variable_wrap
-                                    for item in sorted_variables])
-        command = eval("lambda " + input_sequence + ": " + command_string, {})
-        return command
+        if fallback is not None:
+            # try: <statements>; result = <expression> except Exception: return fallback(<parameters>)
+            statements.append(ast.Assign(targets=[ast.Name(id="result", ctx=ast.Store(), **_LOCATION)],
+                                         value=expression, **_LOCATION))
+            call = ast.Call(func=ast.Name(id=_FALLBACK, ctx=ast.Load(), **_LOCATION),
+                            args=[ast.Name(id=parameter, ctx=ast.Load(), **_LOCATION)
+                                  for parameter in parameters.values()], keywords=[], **_LOCATION)
+            handler = ast.ExceptHandler(type=ast.Name(id="Exception", ctx=ast.Load(), **_LOCATION), name=None,
+                                        body=[ast.Return(value=call, **_LOCATION)], **_LOCATION)
+            statements = [ast.Try(body=statements, handlers=[handler], orelse=[], finalbody=[], **_LOCATION)]
+            expression = ast.Name(id="result", ctx=ast.Load(), **_LOCATION)
+            namespace = {**namespace, _FALLBACK: fallback, "Exception": Exception}
+
+        return _build_function(list(parameters.values()), statements, expression, namespace=namespace)
 
     @staticmethod
-    def _parse_input(input_string: str, keyword_value_map: dict) -> (str, set):
+    def _hoist_casts(tree: "Node", load_value, local_name) -> (list, dict):
         """
-        Parses the input based off of the comparisons
-        :param input_string: A string that has already passed basic safety checks
-        :param keyword_value_map: A map of reserved keywords that map to certain values
-        :return: A string with the valid operators and the operators that have been corrected
+        Builds the references to the cast variables of a tree, a variable that is cast to the same type more than
+        once is assigned to a local once so it is only cast once per call.
+        Only casts that are evaluated on every call are hoisted, a cast in an operand that && or || can skip stays
+        inline, so a value that can not be cast only raises when check would reach it.
+        :param tree: The parsed expression tree
+        :param load_value: Called with a variable name, returns the ast node that loads its uncast value
+        :param local_name: Called with a variable name and type, returns the name of the local that holds the cast
+        :return: The statements that assign the locals and the references for Node.to_python
         """
+        casts = Counter((node.name, node.variable_type) for node in tree.walk() if isinstance(node, Variable))
+
+        # The variables in evaluation order that are always evaluated, only the first operand of && and || is
+        always_evaluated = []
+        pending = [tree]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, Variable):
+                always_evaluated.append((node.name, node.variable_type))
+            elif isinstance(node, _Junction):
+                pending.append(node.operands[0])
+            else:
+                pending.extend(reversed(node.children()))
 
-        # Handle comparisons first
-        variables_hold = set()
-        output = input_string
-        for comparison in COMPARISONS:
-            output, variables = StringBooleanExpression._handle_comparison(output, comparison[0], comparison[1],
-                                                                           keyword_value_map)
-            variables_hold.update(variables)
+        def cast(name: str, variable_type: str) -> ast.Call:
+            return ast.Call(func=ast.Name(id=variable_type, ctx=ast.Load(), **_LOCATION), args=[load_value(name)],
+                            keywords=[], **_LOCATION)
 
-        output = output.replace(AND_OP[0], AND_OP[1])
-        output = output.replace(OR_OP[0], OR_OP[1])
-        output = output.replace(NOT_OP[0], NOT_OP[1])
+        statements = []
+        references = {}
+        for name, variable_type in dict.fromkeys(always_evaluated):
+            if casts[(name, variable_type)] > 1:
+                local = local_name(name, variable_type)
+                statements.append(ast.Assign(targets=[ast.Name(id=local, ctx=ast.Store(), **_LOCATION)],
+                                             value=cast(name, variable_type), **_LOCATION))
+                references[(name, variable_type)] = lambda local=local: ast.Name(id=local, ctx=ast.Load(), **_LOCATION)
+        for variable in casts:
+            if variable not in references:
+                references[variable] = lambda variable=variable: cast(*variable)
 
-        return output, variables_hold
+        return statements, references
 
     @staticmethod
-    def _handle_comparison(input_string: str, comparison_operator: str, replacement: str,
-                           keyword_value_map: dict) -> (str, set):
-        """
-        Splits based off of a comparison operator and the handles the left and right side of the operator
-        :param input_string:
-        :param comparison_operator: This would be index zero from and entry in COMPARISONS
-        :param replacement: This would index one from and entry in COMPARISONS
-        :param keyword_value_map: The map of certain keywords to replace with other values
-        :return: Updated string and a set of the variables found
-        """
-        variables = set()
-
-        parts = input_string.split(comparison_operator)
-
-        if len(parts) == 1:
-            return input_string, variables
-
-        for left_index, right_index in zip(range(0, len(parts) - 1), range(1, len(parts))):
-            left_part = parts[left_index]
-            right_part = parts[right_index]
-
-            # Look right to left until end of string or open group or operator or variable start and then type
-            left_item_length = 0
-            left_value_length = 0
-            previous_item = ""
-            left_variable_type = ""
-            left_is_variable = False
-            for i in range(len(left_part) - 1, -1, -1):
-                current_char = left_part[i]
-                # open group case
-                if current_char == GROUP_OPEN:
-                    break
-                if current_char + previous_item in {AND_OP[0], OR_OP[0], NOT_OP[0]}:
-                    # Moving back one item because the previous item was incremented
-                    left_item_length -= 1
-                    left_value_length -= 1
-                    break
-                if previous_item == VARIABLE_START:
-                    if current_char == STRING[0]:
-                        left_variable_type = STRING[1]
-                    elif current_char == FLOAT[0]:
-                        left_variable_type = FLOAT[1]
-                    elif current_char == INTEGER[0]:
-                        left_variable_type = INTEGER[1]
-                    else:
-                        raise ValueError(f"Invalid type ({current_char}) for variable in {input_string}.")
-                    left_item_length += 1
-                    left_value_length -= 1
-                    left_is_variable = True
-                    break
+    def _set_up_vectorized_function(tree: "Node", variable_wrap: str = INTERNAL_VARIABLE_WRAP_CHAR):
+        """
+        Compiles the expression tree into a function that operates on whole NumPy arrays instead of single values.
+        The "and", "or" and "not" operators become their element wise versions and every casted variable is its own
+        argument, so the caller can cast each column once with NumPy before the call.
+        :param tree: The parsed expression tree
+        :param variable_wrap: The string to wrap the variable in
+        :return: The vectorized function and the (variable, type) pairs in the order the function expects them
+        """
+        vectorized_variables = sorted({(node.name, node.variable_type) for node in tree.walk()
+                                       if isinstance(node, Variable)})
+        parameters = [variable_wrap + name + variable_wrap + variable_type
+                      for name, variable_type in vectorized_variables]
+        references = {variable: lambda parameter=parameter: ast.Name(id=parameter, ctx=ast.Load(), **_LOCATION)
+                      for variable, parameter in zip(vectorized_variables, parameters)}
 
-                previous_item = current_char
-                left_item_length += 1
-                left_value_length += 1
-
-            raw_left_value = left_part[-left_value_length:]
-
-            # Handle replacing special values
-            if raw_left_value in keyword_value_map:
-                left_is_variable = False
-                raw_left_value = keyword_value_map[raw_left_value]
-
-            left_value = StringBooleanExpression._wrap_string(raw_left_value, INTERNAL_VARIABLE_WRAP_CHAR,
-                                                              left_is_variable)
-
-            if left_is_variable:
-                variables.add(raw_left_value)
-
-            # Look left to right until end of string or close group or operator (flag variable start)
-            right_item_length = 0
-            right_value_start = 0
-            right_value_stop = 0
-            previous_item = ""
-            right_variable_type = ""
-            right_is_variable = False
-            for i in range(len(right_part)):
-                current_char = right_part[i]
-                # open group case
-                if current_char == GROUP_CLOSE:
-                    break
-                if previous_item + current_char in {AND_OP[0], OR_OP[0], NOT_OP[0]}:
-                    # Moving back one item because the previous item was incremented
-                    right_item_length -= 1
-                    right_value_stop -= 1
-                    break
-                if current_char == VARIABLE_START:
-                    if previous_item == STRING[0]:
-                        right_variable_type = STRING[1]
-                    elif previous_item == FLOAT[0]:
-                        right_variable_type = FLOAT[1]
-                    elif previous_item == INTEGER[0]:
-                        right_variable_type = INTEGER[1]
-                    else:
-                        raise ValueError(f"Invalid type ({current_char}) for variable in {input_string}.")
-                    right_value_start += 2
-                    right_is_variable = True
-
-                previous_item = current_char
-                right_item_length += 1
-                right_value_stop += 1
-            raw_right_value = right_part[right_value_start: right_value_stop]
-
-            # Handle replacing special values
-            if raw_right_value in keyword_value_map:
-                right_is_variable = False
-                raw_right_value = keyword_value_map[raw_right_value]
-
-            right_value = StringBooleanExpression._wrap_string(raw_right_value,
-                                                               INTERNAL_VARIABLE_WRAP_CHAR, right_is_variable)
-            if right_is_variable:
-                variables.add(raw_right_value)
-
-            if right_variable_type == "" and left_variable_type == "":
-                raise ValueError(f"Unknown value type for values (most likely a result of passing a "
-                                 f"constant expression like 1==1): {left_value} and {right_value}")
-            if right_variable_type == "":
-                right_variable_type = left_variable_type
-            if left_variable_type == "":
-                left_variable_type = right_variable_type
-
-            if right_variable_type != left_variable_type:
-                raise ValueError(f"Type mismatch {left_variable_type} not comparable to {right_variable_type} "
-                                 f"for values {left_value} and {right_value}")
-
-            left_value = StringBooleanExpression._wrap_string(left_value, "\"", left_variable_type == STRING[1] and
-                                                              not left_is_variable)
-            right_value = StringBooleanExpression._wrap_string(right_value, "\"", right_variable_type == STRING[1]
-                                                               and not right_is_variable)
-
-            parts[left_index] = f"{left_part[:-left_item_length]} {left_variable_type}({left_value})"
-            parts[right_index] = f"{right_variable_type}({right_value}) {right_part[right_value_stop:]}"
-
-        return replacement.join(parts), variables
+        return _build_function(parameters, [], tree.to_python(references, vectorized=True)), vectorized_variables
+
+    @staticmethod
+    def _parse_input(input_string: str, keyword_value_map: dict) -> ("Node", set):
+        """
+        Parses the input into an expression tree
+        :param input_string: A string that has already passed basic safety checks
+        :param keyword_value_map: A map of reserved keywords that map to certain values
+        :return: The root of the expression tree and the set of variables it uses
+        """
+        tree = _Parser(input_string, StringBooleanExpression._tokenize(input_string), keyword_value_map).parse()
+        return tree, set(tree.variables)
+
+    @staticmethod
+    def _tokenize(input_string: str) -> list:
+        """
+        Splits the input string into tokens in a single pass
+        :param input_string: A string that has already passed basic safety checks
+        :return: A list of (kind, text) tuples, whitespace between tokens is dropped
+        """
+        tokens = []
+        for index, part in enumerate(_TOKEN_PATTERN.split(input_string)):
+            if index % 2 == 0:
+                # Even entries are the text between tokens
+                if part and not part.isspace():
+                    tokens.append((_OPERAND, part))
+            elif part in _COMPARISON_OPERATORS:
+                tokens.append((_COMPARISON, part))
+            else:
+                tokens.append((part, part))
+        return tokens
 
     @staticmethod
-    def _wrap_string(value: str, wrap: str, condition: bool) -> str:
+    def _fold_constant(value: str, variable_type: str):
         """
-        Given a condition this function will wrap a value
-        :param value: The value to wrap
-        :param wrap: The string to use to wrap the value
-        :param condition: The condition to base the wrap logic off of
-        :return: Either a wrapped string if condition is True, otherwise it just returns the input value
+        Casts a constant value to the type of the comparison at parse time
+        :param value: The raw constant value from the input string
+        :param variable_type: The type the value is compared as, index one from STRING, FLOAT or INTEGER
+        :return: The cast constant
         """
-        return (wrap if condition else "") + value + (wrap if condition else "")
+        if variable_type == STRING[1]:
+            return value
+
+        try:
+            return CASTS[variable_type](value)
+        except ValueError:
+            pass
+
+        # Fall back to reading the value as a Python literal, so an integer comparison with 10.5 uses 10
+        try:
+            return CASTS[variable_type](ast.literal_eval(value))
+        except (ValueError, TypeError, SyntaxError, OverflowError):
+            raise ValueError(f"Invalid {variable_type} constant ({value}).") from None
 
     @staticmethod
     def _check_for_invalid(input_string: str) -> None:
@@ -299,3 +836,2030 @@ class StringBooleanExpression:
 
         if len(invalid_found) > 0:
             raise ValueError("Invalid strings found in parameter:" + ", ".join(invalid_found))
+
+
+def load_rules(path, keyword_value_mapping=None, use_cache: bool = True) -> list:
+    """
+    NOTE: This can raise a ValueError in the event that a rule was invalid.
+
+    Loads a rules file that has one input string per line, blank lines are skipped.
+    When use_cache is True the parsed rules are kept in a cache file next to the rules file, at the path of the rules
+    file plus RULE_CACHE_SUFFIX. The cache is keyed on a hash of the file content, the keyword mapping and the cache
+    format version, so later loads of an unchanged file skip parsing. A cache file that can not be used is rebuilt.
+    The cache file only holds the serialized expression trees, which are checked by Node.deserialize and compiled on
+    load, so it can not run code even if it was written by someone else.
+    :param path: The path of the rules file
+    :param keyword_value_mapping: The same as StringBooleanExpression
+    :param use_cache: If False the cache file is neither read nor written
+    :return: A StringBooleanExpression for each rule, in file order
+    """
+    if keyword_value_mapping is None:
+        keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
+
+    with open(path, "rb") as rules_file:
+        content = rules_file.read()
+
+    cache_path = os.fspath(path) + RULE_CACHE_SUFFIX
+    cache_key = hashlib.sha256(content + repr(sorted(keyword_value_mapping.items())).encode("utf-8") +
+                               str(_RULE_CACHE_VERSION).encode("utf-8")).hexdigest()
+    if use_cache:
+        expressions = _read_rule_cache(cache_path, cache_key)
+        if expressions is not None:
+            return expressions
+
+    expressions = [StringBooleanExpression(rule, keyword_value_mapping) for _, rule in _split_rules(content)]
+    if use_cache:
+        _write_rule_cache(cache_path, cache_key, expressions)
+    return expressions
+
+
+def find_duplicate_rules(path, keyword_value_mapping=None) -> list:
+    """
+    NOTE: This can raise a ValueError in the event that a rule was invalid.
+
+    Finds the rules of a rules file, see load_rules, that are the same once simplified and use the same fields, for
+    example S$name==bob&&F$salary>>10 and (F$salary>>20||F$salary>>10)&&bob==S$name
+    :param path: The path of the rules file
+    :param keyword_value_mapping: The same as StringBooleanExpression
+    :return: A list with the line numbers of each group of duplicate rules, for every group with more than one rule
+             in file order
+    """
+    if keyword_value_mapping is None:
+        keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
+
+    with open(path, "rb") as rules_file:
+        content = rules_file.read()
+
+    # Maps the fields and simplified tree of a rule to the line numbers it is on
+    groups = {}
+    for line_number, rule in _split_rules(content):
+        try:
+            StringBooleanExpression._check_for_invalid(rule)
+            tree, variables = StringBooleanExpression._parse_input(rule, keyword_value_mapping)
+        except ValueError as error:
+            raise ValueError(f"Line {line_number}: {error}") from None
+        groups.setdefault((frozenset(variables), tree.simplified()), []).append(line_number)
+    return [line_numbers for line_numbers in groups.values() if len(line_numbers) > 1]
+
+
+def _split_rules(content: bytes) -> list:
+    """
+    :param content: The content of a rules file
+    :return: The (line number, input string) of every line that is not blank
+    """
+    lines = content.decode("utf-8").split("\n")
+    return [(line_number, line.rstrip("\r")) for line_number, line in enumerate(lines, 1) if line.strip()]
+
+
+def _read_rule_cache(cache_path: str, cache_key: str):
+    """
+    :param cache_path: The path of the cache file
+    :param cache_key: The key the cache file needs to have to be used
+    :return: The cached expressions, or None if there is no usable cache file
+    """
+    try:
+        with open(cache_path, "rb") as cache_file:
+            # Loading from the bytes is much faster than marshal.load, which reads the file in small pieces
+            key, rules = marshal.loads(cache_file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if key != cache_key:
+        return None
+    try:
+        # Compiling the commands deserializes and checks the trees
+        return [StringBooleanExpression.deserialize(serialized) for serialized in rules]
+    except Exception:
+        return None
+
+
+def _write_rule_cache(cache_path: str, cache_key: str, expressions: list) -> None:
+    """
+    Writes the cache file through a temporary file, failing to write it is not an error
+    :param cache_path: The path of the cache file
+    :param cache_key: The key to store in the cache file
+    :param expressions: The expressions to cache
+    """
+    data = marshal.dumps((cache_key, [expression.serialize() for expression in expressions]))
+    try:
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or ".")
+    except OSError:
+        return
+    try:
+        with os.fdopen(descriptor, "wb") as cache_file:
+            cache_file.write(data)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temporary_path)
+
+
+def _build_function(parameters: list, statements: list, expression: ast.expr, name: str = "command",
+                    namespace: dict = _COMMAND_GLOBALS):
+    """
+    Compiles a function straight from ast nodes
+    :param parameters: The names of the function parameters
+    :param statements: Statements to run before the expression is returned
+    :param expression: The expression the function returns
+    :param name: The name of the function
+    :param namespace: The globals of the function, the only names it can see
+    :return: The compiled function
+    """
+    arguments = ast.arguments(args=[ast.arg(arg=parameter, annotation=None, **_LOCATION) for parameter in parameters],
+                              vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    function = ast.FunctionDef(name=name, args=arguments, body=statements + [ast.Return(value=expression, **_LOCATION)],
+                               decorator_list=[], returns=None, **_LOCATION)
+    module = ast.Module(body=[function])
+    # Fields that only exist in newer versions of Python
+    for node, field in [(arguments, "posonlyargs"), (function, "type_params"), (module, "type_ignores")]:
+        if field in node._fields:
+            setattr(node, field, [])
+
+    code = compile(module, "<StringBooleanExpression>", "exec")
+    return types.FunctionType(next(const for const in code.co_consts if isinstance(const, types.CodeType)),
+                              namespace)
+
+
+def _subscript(value: ast.expr, index) -> ast.Subscript:
+    """
+    :return: The ast node for value[index]
+    """
+    index = ast.Constant(value=index, **_LOCATION)
+    if sys.version_info < (3, 9):
+        index = ast.Index(value=index)
+    return ast.Subscript(value=value, slice=index, ctx=ast.Load(), **_LOCATION)
+
+
+class Node:
+    """
+    A node in the expression tree that an input string is parsed into.
+    Every node knows the set of variables that it and its children depend on.
+    """
+    __slots__ = ("variables", "_hash")
+
+    def children(self) -> tuple:
+        """
+        :return: The direct children of the node
+        """
+        return ()
+
+    def walk(self):
+        """
+        Yields this node and all of its descendants, parents before their children
+        """
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes.extend(reversed(node.children()))
+
+    def serialize(self) -> tuple:
+        """
+        :return: The tree as nested tuples of the node type name and its arguments, see deserialize
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def deserialize(data: tuple) -> "Node":
+        """
+        NOTE: This raises a ValueError for data that is not a tree serialize could have made.
+
+        The node types, comparison operators, variable types and constant types are checked, so the compiled command
+        of a rebuilt tree can only cast fields and compare them, whatever the data came from.
+        :param data: The output of serialize
+        :return: The rebuilt tree
+        """
+        node_type = data[0]
+        if node_type == "Variable":
+            if not isinstance(data[1], str) or data[2] not in CASTS:
+                raise ValueError(f"Invalid variable ({data[1:]}).")
+            return Variable(data[1], data[2])
+        if node_type == "Constant":
+            if type(data[1]) not in CASTS.values():
+                raise ValueError(f"Invalid constant type ({type(data[1]).__name__}).")
+            return Constant(data[1])
+        if node_type == "Comparison":
+            if data[1] not in _COMPARISON_OPERATORS:
+                raise ValueError(f"Unknown comparison operator ({data[1]}).")
+            return Comparison(data[1], Node.deserialize(data[2]), Node.deserialize(data[3]))
+        if node_type == "Not":
+            return Not(Node.deserialize(data[1]))
+        if node_type == "And":
+            return And([Node.deserialize(operand) for operand in data[1]])
+        if node_type == "Or":
+            return Or([Node.deserialize(operand) for operand in data[1]])
+        raise ValueError(f"Unknown node type ({node_type}).")
+
+    def map_comparisons(self, function) -> "Node":
+        """
+        :param function: Called with every Comparison in the tree, returns the node to use in its place
+        :return: A copy of the tree with the comparisons replaced, nodes without comparisons are reused
+        """
+        return self
+
+    def canonical(self) -> "Node":
+        """
+        The canonical form has comparisons with the variable on the left, no nested groups of the same operator, no
+        duplicate operands, operands in a fixed order and no double negation. Trees that only differ in these have
+        equal canonical forms. It has the same result as the node for every record that resolves, like adaptive
+        ordering a record that raises for one order of operands can resolve for another.
+        :return: The canonical form of the tree, the node itself when it is already canonical
+        """
+        return self
+
+    def simplified(self) -> "Node":
+        """
+        The canonical form without redundant comparisons and clauses. Comparisons of the same variable against
+        constants are merged when one implies the other, F$x>>10||F$x>>20 becomes F$x>>10 and F$x>>10&&F$x>>20 becomes
+        F$x>>20, or when together they are one comparison, F$x>>10||F$x==10 becomes F$x>=10. Clauses that are implied
+        by another clause of an && or imply another clause of an || are removed, S$a==b||(S$a==b&&S$c==d) becomes
+        S$a==b. The simplified tree can use fewer fields than the node.
+        :return: The simplified form of the tree
+        """
+        tree = self.canonical()
+        while True:
+            simplified = tree._simplify()
+            if simplified is tree:
+                return tree
+            simplified = simplified.canonical()
+            if simplified == tree:
+                return tree
+            tree = simplified
+
+    def _simplify(self) -> "Node":
+        """
+        :return: The canonical node after one pass of simplification, see simplified, the node itself when nothing
+                 was simplified
+        """
+        return self
+
+    def _key(self) -> tuple:
+        """
+        :return: The values that make two nodes of the same type equal
+        """
+        raise NotImplementedError
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        # Nodes are not changed after they are built, so the hash is only computed once
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash((type(self).__name__, self._key()))
+            return self._hash
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        """
+        Converts the node to a Python ast expression
+        :param references: Maps (variable name, type) to a function returning the ast node that references the cast
+                           value of that variable
+        :param vectorized: If True the boolean operators are converted to their element wise NumPy versions
+        :return: The ast expression
+        """
+        raise NotImplementedError
+
+    def to_sql(self, reference, parameters: list) -> str:
+        """
+        Converts the node to a SQL expression
+        :param reference: Called with a variable name and type, returns the SQL that references the cast value of
+                          that variable, and a SQL condition that has to be True for the comparison to be True or None
+        :param parameters: The values of the parameters, constants are appended to it and referenced with a ?
+        :return: The SQL expression
+        """
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({str(self)!r})"
+
+
+class Variable(Node):
+    """
+    A field of the input that is cast to a type, for example S$name
+    """
+    __slots__ = ("name", "variable_type")
+
+    def __init__(self, name: str, variable_type: str):
+        self.name = name
+        self.variable_type = variable_type
+        self.variables = frozenset([name])
+
+    def serialize(self) -> tuple:
+        return "Variable", self.name, self.variable_type
+
+    def _key(self) -> tuple:
+        return self.name, self.variable_type
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return references[(self.name, self.variable_type)]()
+
+    def to_sql(self, reference, parameters: list) -> str:
+        return reference(self.name, self.variable_type)[0]
+
+    def __str__(self) -> str:
+        return _TYPE_PREFIXES[self.variable_type] + VARIABLE_START + self.name
+
+
+class Constant(Node):
+    """
+    A constant that has already been cast to the type it is compared as
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+        self.variables = frozenset()
+
+    def serialize(self) -> tuple:
+        return "Constant", self.value
+
+    def _key(self) -> tuple:
+        # The type is part of the key so 1 and 1.0 differ, and every NaN is equal to the others
+        if self.value != self.value:
+            return type(self.value), "nan"
+        return type(self.value), self.value
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return ast.Constant(value=self.value, **_LOCATION)
+
+    def to_sql(self, reference, parameters: list) -> str:
+        parameters.append(self.value)
+        return "?"
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+
+class Comparison(Node):
+    """
+    A comparison between two operands, at least one of them is a Variable
+    """
+    __slots__ = ("operator", "left", "right")
+
+    def __init__(self, operator: str, left: Node, right: Node):
+        self.operator = operator
+        self.left = left
+        self.right = right
+        self.variables = left.variables | right.variables
+
+    def children(self) -> tuple:
+        return self.left, self.right
+
+    def serialize(self) -> tuple:
+        return "Comparison", self.operator, self.left.serialize(), self.right.serialize()
+
+    def map_comparisons(self, function) -> Node:
+        return function(self)
+
+    def swapped(self) -> "Comparison":
+        """
+        :return: The equivalent comparison with the operands swapped, bob==S$name becomes S$name==bob
+        """
+        operator = _OPERATOR_TOKENS[_SWAPPED_OPERATORS[_COMPARISON_OPERATORS[self.operator]]]
+        return Comparison(operator, self.right, self.left)
+
+    def oriented(self) -> "Comparison":
+        """
+        :return: The equivalent comparison with a Variable on the left
+        """
+        return self.swapped() if isinstance(self.left, Constant) else self
+
+    def negated(self):
+        """
+        :return: The comparison that is True when this one is False, or None when there is none because a float
+                 operand can be NaN, which makes both F$x<<1 and F$x>=1 False
+        """
+        comparison_operator = _COMPARISON_OPERATORS[self.operator]
+        if comparison_operator not in (ast.Eq, ast.NotEq) and any(
+                isinstance(operand, Variable) and operand.variable_type == FLOAT[1] for operand in self.children()):
+            return None
+        return Comparison(_OPERATOR_TOKENS[_NEGATED_OPERATORS[comparison_operator]], self.left, self.right)
+
+    def canonical(self) -> Node:
+        comparison = self.oriented()
+        if isinstance(comparison.right, Variable) and str(comparison.right) < str(comparison.left):
+            comparison = comparison.swapped()
+        return comparison
+
+    def _key(self) -> tuple:
+        return self.operator, self.left, self.right
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return ast.Compare(left=self.left.to_python(references, vectorized),
+                           ops=[_COMPARISON_OPERATORS[self.operator]()],
+                           comparators=[self.right.to_python(references, vectorized)], **_LOCATION)
+
+    def to_sql(self, reference, parameters: list) -> str:
+        condition = f"{self.left.to_sql(reference, parameters)} {_SQL_OPERATORS[self.operator]} " \
+                    f"{self.right.to_sql(reference, parameters)}"
+        guards = []
+        for operand in self.children():
+            if isinstance(operand, Variable):
+                guard = reference(operand.name, operand.variable_type)[1]
+                if guard is not None and guard not in guards:
+                    guards.append(guard)
+        if not guards:
+            return condition
+        return GROUP_OPEN + " AND ".join([condition] + guards) + GROUP_CLOSE
+
+    def __str__(self) -> str:
+        return f"{self.left}{self.operator}{self.right}"
+
+
+class _Junction(Node):
+    """
+    The shared base of And and Or, a list of operands joined by a boolean operator
+    """
+    __slots__ = ("operands",)
+    token = None
+    _boolean_operator = None
+    _vectorized_operator = None
+    _sql_operator = None
+
+    def __init__(self, operands):
+        self.operands = tuple(operands)
+        self.variables = frozenset().union(*[operand.variables for operand in self.operands])
+
+    def children(self) -> tuple:
+        return self.operands
+
+    def serialize(self) -> tuple:
+        return type(self).__name__, tuple(operand.serialize() for operand in self.operands)
+
+    def map_comparisons(self, function) -> Node:
+        return type(self)([operand.map_comparisons(function) for operand in self.operands])
+
+    def canonical(self) -> Node:
+        operands = []
+        for operand in self.operands:
+            operand = operand.canonical()
+            operands.extend(operand.operands if type(operand) is type(self) else [operand])
+        operands = sorted(dict.fromkeys(operands), key=str)
+        if len(operands) == 1:
+            return operands[0]
+        return self._rebuilt(operands)
+
+    def _simplify(self) -> Node:
+        operands = self._merge_bounds([operand._simplify() for operand in self.operands])
+        if len(operands) > _ABSORPTION_LIMIT:
+            return self._rebuilt(operands)
+
+        removed = set()
+        for position, operand in enumerate(operands):
+            if any(other_position != position and other_position not in removed and self._redundant(operand, other)
+                   for other_position, other in enumerate(operands)):
+                removed.add(position)
+        return self._rebuilt([operand for position, operand in enumerate(operands) if position not in removed])
+
+    def _rebuilt(self, operands: list) -> Node:
+        """
+        :return: The junction of the same type with the operands, the junction itself when it already has them
+        """
+        if len(operands) == len(self.operands) and all(map(operator.is_, operands, self.operands)):
+            return self
+        return type(self)(operands)
+
+    def _merge_bounds(self, operands: list) -> list:
+        """
+        :param operands: The canonical operands of the junction
+        :return: The operands with a pair of comparisons of each variable and constant that is one comparison together
+                 replaced by it
+        """
+        # Maps a variable and constant to the comparisons against it by operator
+        groups = {}
+        for operand in operands:
+            bound = _bound(operand)
+            if bound is not None:
+                groups.setdefault((bound[0], bound[1], bound[3]), {})[bound[2]] = operand
+
+        replacements = {}
+        for group in groups.values():
+            for pair in itertools.combinations(group, 2):
+                merged = self._merged_bounds.get(frozenset(pair))
+                if merged is not None:
+                    first, second = group[pair[0]], group[pair[1]]
+                    replacements[id(first)] = Comparison(_OPERATOR_TOKENS[merged], first.left, first.right)
+                    replacements[id(second)] = None
+                    break
+
+        merged_operands = []
+        for operand in operands:
+            operand = replacements.get(id(operand), operand)
+            if operand is not None:
+                merged_operands.append(operand)
+        return merged_operands
+
+    @staticmethod
+    def _redundant(operand: Node, other: Node) -> bool:
+        """
+        :return: If the operand can be removed from the junction because of the other operand
+        """
+        raise NotImplementedError
+
+    def _key(self) -> tuple:
+        return self.operands
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        values = [operand.to_python(references, vectorized) for operand in self.operands]
+        if not vectorized:
+            return ast.BoolOp(op=self._boolean_operator(), values=values, **_LOCATION)
+
+        result = values[0]
+        for value in values[1:]:
+            result = ast.BinOp(left=result, op=self._vectorized_operator(), right=value, **_LOCATION)
+        return result
+
+    def to_sql(self, reference, parameters: list) -> str:
+        return GROUP_OPEN + f" {self._sql_operator} ".join(operand.to_sql(reference, parameters)
+                                                           for operand in self.operands) + GROUP_CLOSE
+
+
+class And(_Junction):
+    """
+    True when all of the operands are True
+    """
+    __slots__ = ()
+    token = AND_OP[0]
+    _boolean_operator = ast.And
+    _vectorized_operator = ast.BitAnd
+    _sql_operator = "AND"
+    # Pairs of comparisons of a variable against the same constant that are one comparison together
+    _merged_bounds = {frozenset([ast.GtE, ast.LtE]): ast.Eq, frozenset([ast.GtE, ast.NotEq]): ast.Gt,
+                      frozenset([ast.LtE, ast.NotEq]): ast.Lt}
+
+    @staticmethod
+    def _redundant(operand: Node, other: Node) -> bool:
+        return _implies(other, operand)
+
+    def __str__(self) -> str:
+        return self.token.join(f"{GROUP_OPEN}{operand}{GROUP_CLOSE}" if isinstance(operand, Or) else str(operand)
+                               for operand in self.operands)
+
+
+class Or(_Junction):
+    """
+    True when any of the operands is True
+    """
+    __slots__ = ()
+    token = OR_OP[0]
+    _boolean_operator = ast.Or
+    _vectorized_operator = ast.BitOr
+    _sql_operator = "OR"
+    # Pairs of comparisons of a variable against the same constant that are one comparison together
+    _merged_bounds = {frozenset([ast.Eq, ast.Gt]): ast.GtE, frozenset([ast.Eq, ast.Lt]): ast.LtE}
+
+    @staticmethod
+    def _redundant(operand: Node, other: Node) -> bool:
+        return _implies(operand, other)
+
+    def __str__(self) -> str:
+        return self.token.join(str(operand) for operand in self.operands)
+
+
+class Not(Node):
+    """
+    True when the operand is False
+    """
+    __slots__ = ("operand",)
+
+    def __init__(self, operand: Node):
+        self.operand = operand
+        self.variables = operand.variables
+
+    def children(self) -> tuple:
+        return self.operand,
+
+    def serialize(self) -> tuple:
+        return "Not", self.operand.serialize()
+
+    def map_comparisons(self, function) -> Node:
+        return Not(self.operand.map_comparisons(function))
+
+    def canonical(self) -> Node:
+        operand = self.operand.canonical()
+        if isinstance(operand, Not):
+            return operand.operand
+        if isinstance(operand, Comparison):
+            negated = operand.negated()
+            if negated is not None:
+                return negated
+        return self if operand is self.operand else Not(operand)
+
+    def _simplify(self) -> Node:
+        operand = self.operand._simplify()
+        return self if operand is self.operand else Not(operand)
+
+    def _key(self) -> tuple:
+        return self.operand,
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return ast.UnaryOp(op=ast.Invert() if vectorized else ast.Not(),
+                           operand=self.operand.to_python(references, vectorized), **_LOCATION)
+
+    def to_sql(self, reference, parameters: list) -> str:
+        operand = self.operand.to_sql(reference, parameters)
+        return f"NOT {operand}" if isinstance(self.operand, _Junction) else f"NOT {GROUP_OPEN}{operand}{GROUP_CLOSE}"
+
+    def __str__(self) -> str:
+        if isinstance(self.operand, _Junction):
+            return f"{NOT_OP[0]}{GROUP_OPEN}{self.operand}{GROUP_CLOSE}"
+        return f"{NOT_OP[0]}{self.operand}"
+
+
+def _bound(node: Node):
+    """
+    :param node: A canonical node
+    :return: The (variable name, variable type, ast operator, constant) of a comparison of a variable against a
+             constant that is not NaN, or None for any other node
+    """
+    if type(node) is not Comparison or type(node.right) is not Constant or node.right.value != node.right.value:
+        return None
+    return node.left.name, node.left.variable_type, _COMPARISON_OPERATORS[node.operator], node.right.value
+
+
+def _bound_implies(first: tuple, second: tuple) -> bool:
+    """
+    :param first: A bound from _bound
+    :param second: A bound from _bound of the same variable and type
+    :return: If every value that the first comparison is True for makes the second one True
+    """
+    _, _, first_operator, first_value = first
+    _, _, second_operator, second_value = second
+    if first_operator is ast.Eq:
+        return _OPERATOR_FUNCTIONS[second_operator](first_value, second_value)
+    if first_operator is ast.NotEq:
+        return second_operator is ast.NotEq and first_value == second_value
+    if second_operator is ast.NotEq:
+        # Only when the excluded value is one the first comparison is False for
+        return not _OPERATOR_FUNCTIONS[first_operator](second_value, first_value)
+    if second_operator is ast.Eq:
+        return False
+
+    for bounds, tighter in [(_LOWER_BOUNDS, operator.gt), (_UPPER_BOUNDS, operator.lt)]:
+        if first_operator in bounds and second_operator in bounds:
+            return tighter(first_value, second_value) or (
+                first_value == second_value and not (first_operator in (ast.GtE, ast.LtE) and
+                                                     second_operator in (ast.Gt, ast.Lt)))
+    return False
+
+
+def _implies(first: Node, second: Node) -> bool:
+    """
+    :param first: A canonical node
+    :param second: A canonical node
+    :return: If the second node is True for every record the first node is True for, False when that is not known
+    """
+    if first == second:
+        return True
+    if isinstance(second, Or) and any(_implies(first, operand) for operand in second.operands):
+        return True
+    if isinstance(first, And) and any(_implies(operand, second) for operand in first.operands):
+        return True
+    if isinstance(first, Or):
+        return all(_implies(operand, second) for operand in first.operands)
+    if isinstance(second, And):
+        return all(_implies(first, operand) for operand in second.operands)
+
+    first_bound, second_bound = _bound(first), _bound(second)
+    return first_bound is not None and second_bound is not None and first_bound[:2] == second_bound[:2] and \
+        _bound_implies(first_bound, second_bound)
+
+
+class _Probe(Node):
+    """
+    Wraps a node of an instrumented or sampling command, passes the result of the node to the probe function which
+    counts it and returns it
+    """
+    __slots__ = ("index", "operand")
+
+    def __init__(self, index: int, operand: Node):
+        self.index = index
+        self.operand = operand
+        self.variables = operand.variables
+
+    def children(self) -> tuple:
+        return self.operand,
+
+    def _key(self) -> tuple:
+        return self.index, self.operand
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return ast.Call(func=ast.Name(id=_PROBE, ctx=ast.Load(), **_LOCATION),
+                        args=[ast.Constant(value=self.index, **_LOCATION),
+                              self.operand.to_python(references, vectorized)], keywords=[], **_LOCATION)
+
+    def __str__(self) -> str:
+        return str(self.operand)
+
+
+class _Instrumentation:
+    """
+    The statistics of an instrumented expression and the command that records them
+    """
+    __slots__ = ("comparisons", "counts", "command", "evaluations", "total_time", "missing_fields")
+
+    def __init__(self, tree: Node, sorted_variables: list):
+        self.comparisons = []
+
+        def probe_comparison(comparison: Comparison) -> _Probe:
+            self.comparisons.append(comparison)
+            return _Probe(len(self.comparisons) - 1, comparison)
+
+        probed_tree = tree.map_comparisons(probe_comparison)
+        self.counts = [[0, 0] for _ in self.comparisons]
+        self.reset()
+
+        counts = self.counts
+
+        def probe(index: int, result: bool) -> bool:
+            counts[index][result] += 1
+            return result
+
+        self.command = StringBooleanExpression._set_up_function(probed_tree, sorted_variables,
+                                                                namespace={**_COMMAND_GLOBALS, _PROBE: probe})
+
+    def reset(self) -> None:
+        for counts in self.counts:
+            counts[:] = [0, 0]
+        self.evaluations = 0
+        self.total_time = 0.0
+        self.missing_fields = 0
+
+
+class _AdaptiveOrdering:
+    """
+    Samples how often each operand of every && and || of an expression decides the result, then reorders them
+    """
+    __slots__ = ("expression", "sample_size", "samples", "counts", "original_command", "sampling_command", "tree")
+
+    def __init__(self, expression: StringBooleanExpression, sample_size: int):
+        self.expression = expression
+        self.sample_size = sample_size
+        self.samples = 0
+        # The number of times each operand was False and True, in the order _probe_operands visits them
+        self.counts = []
+        self.original_command = expression._command
+        # The reordered tree, only set once enough evaluations were sampled
+        self.tree = None
+
+        counts = self.counts
+
+        def probe(index: int, result: bool) -> bool:
+            counts[index][result] += 1
+            return result
+
+        probed_command = StringBooleanExpression._set_up_function(self._probe_operands(expression._tree),
+                                                                  expression._sorted_variables,
+                                                                  namespace={**_COMMAND_GLOBALS, _PROBE: probe})
+
+        def sampling_command(*arguments) -> bool:
+            result = probed_command(*arguments)
+            self.samples += 1
+            if self.samples >= self.sample_size and self.tree is None:
+                self.reorder()
+            return result
+
+        self.sampling_command = sampling_command
+
+    def _probe_operands(self, node: Node) -> Node:
+        """
+        :return: A copy of the tree with every operand of an And or Or wrapped in a _Probe
+        """
+        if isinstance(node, _Junction):
+            operands = []
+            for operand in node.operands:
+                self.counts.append([0, 0])
+                operands.append(_Probe(len(self.counts) - 1, self._probe_operands(operand)))
+            return type(node)(operands)
+        if isinstance(node, Not):
+            return Not(self._probe_operands(node.operand))
+        return node
+
+    def reorder(self) -> None:
+        """
+        Replaces the command of the expression with one compiled from the tree with the operands reordered
+        """
+        self.tree = self._ordered(self.expression._tree, iter(self.counts))
+        self.expression._command = StringBooleanExpression._set_up_function(self.tree,
+                                                                            self.expression._sorted_variables,
+                                                                            fallback=self.original_command)
+
+    @staticmethod
+    def _ordered(node: Node, counts) -> Node:
+        """
+        Sorts the operands of every And and Or by the number of comparisons they contain divided by the chance that
+        they decide the result, True for an Or and False for an And. The chance is smoothed so an operand that was never
+        reached counts as a coin flip.
+        :param node: The node to reorder
+        :param counts: An iterator of the counts in the order _probe_operands visited the operands
+        :return: A copy of the tree with the operands reordered
+        """
+        if isinstance(node, _Junction):
+            scored = []
+            for operand in node.operands:
+                operand_counts = next(counts)
+                decided = operand_counts[isinstance(node, Or)]
+                chance = (decided + 1) / (sum(operand_counts) + 2)
+                cost = sum(1 for child in operand.walk() if isinstance(child, Comparison))
+                scored.append((cost / chance, _AdaptiveOrdering._ordered(operand, counts)))
+            # The sort is stable so operands that score the same keep their order
+            return type(node)([operand for _, operand in sorted(scored, key=lambda item: item[0])])
+        if isinstance(node, Not):
+            return Not(_AdaptiveOrdering._ordered(node.operand, counts))
+        return node
+
+
+class _Parser:
+    """
+    A recursive descent parser that turns the tokens of an input string into an expression tree.
+    "!!" binds tighter than "&&" which binds tighter than "||".
+    """
+    __slots__ = ("_input_string", "_tokens", "_position", "_keyword_value_map", "_depth")
+
+    def __init__(self, input_string: str, tokens: list, keyword_value_map: dict):
+        self._input_string = input_string
+        self._tokens = tokens
+        self._position = 0
+        self._keyword_value_map = keyword_value_map
+        # The number of groups and not operators the current position is nested in
+        self._depth = 0
+
+    def parse(self) -> Node:
+        """
+        NOTE: This raises a ValueError if the tokens do not form a valid expression.
+        :return: The root of the expression tree
+        """
+        tree = self._parse_or()
+        if self._position < len(self._tokens):
+            raise self._error(f"Unexpected \"{self._tokens[self._position][1]}\"")
+        return tree
+
+    def _peek(self):
+        return self._tokens[self._position][0] if self._position < len(self._tokens) else None
+
+    def _parse_or(self) -> Node:
+        operands = [self._parse_and()]
+        while self._peek() == OR_OP[0]:
+            self._position += 1
+            operands.append(self._parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def _parse_and(self) -> Node:
+        operands = [self._parse_not()]
+        while self._peek() == AND_OP[0]:
+            self._position += 1
+            operands.append(self._parse_not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def _parse_not(self) -> Node:
+        if self._peek() == NOT_OP[0]:
+            self._position += 1
+            self._enter()
+            tree = Not(self._parse_not())
+            self._depth -= 1
+            return tree
+        return self._parse_group()
+
+    def _parse_group(self) -> Node:
+        if self._peek() != GROUP_OPEN:
+            return self._parse_comparison()
+
+        self._position += 1
+        self._enter()
+        tree = self._parse_or()
+        if self._peek() != GROUP_CLOSE:
+            raise self._error(f"Missing \"{GROUP_CLOSE}\"")
+        self._position += 1
+        self._depth -= 1
+        return tree
+
+    def _enter(self) -> None:
+        """
+        NOTE: This raises a ValueError if the groups and not operators are nested deeper than MAX_NESTING.
+        """
+        self._depth += 1
+        if self._depth > MAX_NESTING:
+            raise self._error(f"More than {MAX_NESTING} nested groups and not operators")
+
+    def _parse_comparison(self) -> Comparison:
+        tokens = self._tokens[self._position:self._position + 3]
+        if [kind for kind, _ in tokens] != [_OPERAND, _COMPARISON, _OPERAND]:
+            raise self._error(f"Expected a comparison at token {self._position + 1}")
+        self._position += 3
+
+        left = self._parse_operand(tokens[0][1])
+        right = self._parse_operand(tokens[2][1])
+        variable_types = [operand.variable_type for operand in (left, right) if isinstance(operand, Variable)]
+
+        if not variable_types:
+            raise ValueError(f"Unknown value type for values (most likely a result of passing a "
+                             f"constant expression like 1==1): {left} and {right}")
+        if variable_types[0] != variable_types[-1]:
+            raise ValueError(f"Type mismatch {variable_types[0]} not comparable to {variable_types[-1]} "
+                             f"for values {left} and {right}")
+
+        if not isinstance(left, Variable):
+            left = Constant(StringBooleanExpression._fold_constant(left, variable_types[0]))
+        if not isinstance(right, Variable):
+            right = Constant(StringBooleanExpression._fold_constant(right, variable_types[0]))
+        return Comparison(tokens[1][1], left, right)
+
+    def _parse_operand(self, text: str):
+        """
+        :param text: The text of an operand token
+        :return: A Variable, or the raw value of a constant with the keywords replaced
+        """
+        if text in self._keyword_value_map:
+            return self._keyword_value_map[text]
+        if VARIABLE_START not in text:
+            return text
+
+        variable = text.strip()
+        if variable[1:2] != VARIABLE_START or variable[:1] not in _TYPES:
+            raise ValueError(f"Invalid type ({variable.split(VARIABLE_START)[0]}) for variable in "
+                             f"{self._input_string}.")
+        if not variable[2:].isidentifier():
+            raise ValueError(f"Invalid variable name ({variable[2:]}) in {self._input_string}.")
+        return Variable(variable[2:], _TYPES[variable[:1]])
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"{message} in {self._input_string}.")
+
+
+class RuleSet:
+    """
+    Matches a record against many expressions at once.
+    Every rule is split into its comparisons, and identical comparisons are shared between rules. A comparison of a
+    field against a constant is indexed, equality through a hash map and ranges through sorted thresholds. Matching a
+    record therefore only touches the comparisons that are true for it and the rules that use them. Rules made of the
+    same comparisons in the same form share one compiled function, and rules that are redundant in other ways can be
+    added as simplified expressions, see StringBooleanExpression.simplify.
+    """
+    _Rule = namedtuple("_Rule", ["rule_id", "variables", "function", "tree"])
+
+    def __init__(self, rules=None, keyword_value_mapping=None):
+        """
+        NOTE: This can raise a ValueError in the event that a rule was invalid.
+
+        :param rules: A mapping of rule id to rule or an iterable of (rule id, rule) pairs, see add
+        :param keyword_value_mapping: Used for rules that are passed in as strings, the same as StringBooleanExpression
+        """
+        if keyword_value_mapping is None:
+            keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
+        self._keyword_value_mapping = keyword_value_mapping
+
+        self._rules = []
+        self._rule_ids = set()
+        # Rules that can be True without any of their predicates being True, for example !!S$name==bob
+        self._unconditional_rules = []
+
+        # Maps a predicate key to its index, and the index to the positions of the rules that use it
+        self._predicates = {}
+        self._predicate_rules = []
+        # Maps a field name to a _FieldIndex for each type it is cast to
+        self._field_indexes = {}
+        # Comparisons between two variables can not be indexed, they are (index, variables, function) tuples
+        self._residuals = []
+        # Maps the tree of predicate references of a rule to its compiled function
+        self._functions = {}
+        # Maps the position of a rule to its command, only compiled when a field of the rule can not be cast
+        self._commands = {}
+
+        if isinstance(rules, Mapping):
+            rules = rules.items()
+        for rule_id, rule in rules or ():
+            self.add(rule_id, rule)
+
+    def add(self, rule_id, rule) -> None:
+        """
+        NOTE: This can raise a ValueError in the event that the rule was invalid or the rule id is already used.
+
+        :param rule_id: A hashable id that is returned by match when the rule matches
+        :param rule: An input string or a StringBooleanExpression
+        """
+        if rule_id in self._rule_ids:
+            raise ValueError(f"Duplicate rule id {rule_id}")
+
+        if isinstance(rule, StringBooleanExpression):
+            tree, variables = rule._tree, rule._variables
+        else:
+            StringBooleanExpression._check_for_invalid(rule)
+            tree, variables = StringBooleanExpression._parse_input(rule, self._keyword_value_mapping)
+
+        position = len(self._rules)
+        predicate_tree = tree.map_comparisons(self._add_predicate)
+        function = self._functions.get(predicate_tree)
+        if function is None:
+            function = _build_function([_TRUE_PREDICATES], [], predicate_tree.to_python({}))
+            self._functions[predicate_tree] = function
+
+        for index in {node.index for node in predicate_tree.walk() if isinstance(node, _PredicateReference)}:
+            self._predicate_rules[index].append(position)
+        if function(frozenset()):
+            self._unconditional_rules.append(position)
+
+        self._rules.append(self._Rule(rule_id, tuple(sorted(variables)), function, tree))
+        self._rule_ids.add(rule_id)
+
+    def match(self, record: dict) -> list:
+        """
+        NOTE: Like check, this can raise a ValueError if a rule reaches a field that can not be cast to the type it is
+              compared as.
+
+        A rule does not match a record that is missing any of the rule fields, the same as check. The rules that
+        compare a field that can not be cast are evaluated like check, so they only raise if they reach the field.
+        :param record: The dictionary to contain the fields to look for
+        :return: The ids of the matching rules in the order they were added
+        """
+        true_predicates = set()
+        # The predicates that could not be evaluated because a field can not be cast
+        failed_predicates = set()
+        for name, value in record.items():
+            field_indexes = self._field_indexes.get(name)
+            if field_indexes is not None:
+                for field_index in field_indexes.values():
+                    try:
+                        field_index.find_true(value, true_predicates)
+                    except Exception:
+                        failed_predicates.update(field_index.predicates())
+
+        for index, variables, function in self._residuals:
+            if all(variable in record for variable in variables):
+                try:
+                    if function(*[record[item] for item in variables]):
+                        true_predicates.add(index)
+                except Exception:
+                    failed_predicates.add(index)
+
+        candidates = set(self._unconditional_rules)
+        for index in true_predicates:
+            candidates.update(self._predicate_rules[index])
+        checked_rules = {position for index in failed_predicates for position in self._predicate_rules[index]}
+        candidates.update(checked_rules)
+
+        matches = []
+        for position in sorted(candidates):
+            rule = self._rules[position]
+            if not all(variable in record for variable in rule.variables):
+                continue
+            if position in checked_rules:
+                matched = self._command(position)(*[record[item] for item in rule.variables])
+            else:
+                matched = rule.function(true_predicates)
+            if matched:
+                matches.append(rule.rule_id)
+        return matches
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def _command(self, position: int):
+        """
+        :param position: The position of a rule
+        :return: The command of the rule, that takes the values of its sorted fields like the command of check
+        """
+        command = self._commands.get(position)
+        if command is None:
+            rule = self._rules[position]
+            command = StringBooleanExpression._set_up_function(rule.tree, list(rule.variables))
+            self._commands[position] = command
+        return command
+
+    def _add_predicate(self, comparison: Comparison) -> "_PredicateReference":
+        """
+        Finds or adds the predicate for a comparison
+        :param comparison: A comparison from a rule
+        :return: The node that replaces the comparison in the rule
+        """
+        comparison = comparison.oriented()
+        operator = _COMPARISON_OPERATORS[comparison.operator]
+        indexed = isinstance(comparison.right, Constant)
+        if indexed:
+            key = (comparison.left.name, comparison.left.variable_type, operator, comparison.right.value)
+        else:
+            key = (str(comparison),)
+
+        index = self._predicates.get(key)
+        if index is None:
+            index = len(self._predicate_rules)
+            self._predicates[key] = index
+            self._predicate_rules.append([])
+
+            if indexed:
+                field_indexes = self._field_indexes.setdefault(comparison.left.name, {})
+                if comparison.left.variable_type not in field_indexes:
+                    field_indexes[comparison.left.variable_type] = _FieldIndex(comparison.left.variable_type)
+                field_indexes[comparison.left.variable_type].add(operator, comparison.right.value, index)
+            else:
+                variables = sorted(comparison.variables)
+                self._residuals.append((index, tuple(variables),
+                                        StringBooleanExpression._set_up_function(comparison, variables)))
+
+        return _PredicateReference(index, comparison.variables)
+
+
+class _FieldIndex:
+    """
+    The predicates of a RuleSet that compare one field, cast to one type, against a constant
+    """
+    __slots__ = ("cast", "equal", "not_equal", "ranges")
+
+    def __init__(self, variable_type: str):
+        self.cast = CASTS[variable_type]
+        # Map the constant to the predicate index
+        self.equal = {}
+        self.not_equal = {}
+        # Maps the operator to the sorted constants and the predicate index of each constant
+        self.ranges = {ast.Lt: ([], []), ast.LtE: ([], []), ast.Gt: ([], []), ast.GtE: ([], [])}
+
+    def add(self, operator: type, constant, index: int) -> None:
+        """
+        :param operator: The ast comparison operator, with the field on the left and the constant on the right
+        :param constant: The already cast constant
+        :param index: The index of the predicate
+        """
+        if operator is ast.Eq:
+            self.equal[constant] = index
+        elif operator is ast.NotEq:
+            self.not_equal[constant] = index
+        elif constant == constant:
+            # A range against NaN is never True, and would break the order of the sorted constants
+            constants, indexes = self.ranges[operator]
+            position = bisect.bisect_right(constants, constant)
+            constants.insert(position, constant)
+            indexes.insert(position, index)
+
+    def predicates(self) -> list:
+        """
+        :return: The index of every predicate of the field index
+        """
+        indexes = list(self.equal.values()) + list(self.not_equal.values())
+        for _, range_indexes in self.ranges.values():
+            indexes.extend(range_indexes)
+        return indexes
+
+    def find_true(self, value, true_predicates: set) -> None:
+        """
+        :param value: The uncast value of the field
+        :param true_predicates: The set to add the index of every predicate that is True for the value to
+        """
+        value = self.cast(value)
+
+        index = self.equal.get(value)
+        if index is not None:
+            true_predicates.add(index)
+        if self.not_equal:
+            true_predicates.update(index for constant, index in self.not_equal.items() if constant != value)
+        if value != value:
+            # Every range is False for NaN
+            return
+
+        # Each range is true for a contiguous run of its sorted constants
+        constants, indexes = self.ranges[ast.Lt]
+        if constants:
+            true_predicates.update(indexes[bisect.bisect_right(constants, value):])
+        constants, indexes = self.ranges[ast.LtE]
+        if constants:
+            true_predicates.update(indexes[bisect.bisect_left(constants, value):])
+        constants, indexes = self.ranges[ast.Gt]
+        if constants:
+            true_predicates.update(indexes[:bisect.bisect_left(constants, value)])
+        constants, indexes = self.ranges[ast.GtE]
+        if constants:
+            true_predicates.update(indexes[:bisect.bisect_right(constants, value)])
+
+
+class _PredicateReference(Node):
+    """
+    Replaces a comparison in a rule of a RuleSet, True when the index of its predicate is in the true predicates
+    """
+    __slots__ = ("index",)
+
+    def __init__(self, index: int, variables: frozenset):
+        self.index = index
+        self.variables = variables
+
+    def _key(self) -> tuple:
+        return self.index,
+
+    def to_python(self, references: dict, vectorized: bool = False) -> ast.expr:
+        return ast.Compare(left=ast.Constant(value=self.index, **_LOCATION), ops=[ast.In()],
+                           comparators=[ast.Name(id=_TRUE_PREDICATES, ctx=ast.Load(), **_LOCATION)], **_LOCATION)
+
+    def __str__(self) -> str:
+        return f"#{self.index}"
+
+
+class IncrementalEvaluator:
+    """
+    Keeps the results of many expressions for long lived records, and re-evaluates only what a change can affect.
+    The result of every node of an expression tree is cached per record. When fields change, only the expressions
+    that use one of them are evaluated again, and within those only the nodes that depend on a changed field, the
+    cached results of the other nodes are reused.
+    """
+
+    def __init__(self, expressions=None, keyword_value_mapping=None):
+        """
+        NOTE: This can raise a ValueError in the event that an expression was invalid.
+
+        :param expressions: A mapping of expression id to expression or an iterable of (expression id, expression)
+                            pairs, see add
+        :param keyword_value_mapping: Used for expressions that are passed in as strings, the same as
+                                      StringBooleanExpression
+        """
+        if keyword_value_mapping is None:
+            keyword_value_mapping = dict(DEFAULT_KEYWORD_VALUE_MAPPING)
+        self._keyword_value_mapping = keyword_value_mapping
+
+        # Maps an expression id to its _IncrementalTree
+        self._trees = {}
+        # Maps a field name to the ids of the expressions that use it
+        self._field_expressions = {}
+        # Maps a record id to a dictionary of expression id to the cached node results
+        self._records = {}
+
+        if isinstance(expressions, Mapping):
+            expressions = expressions.items()
+        for expression_id, expression in expressions or ():
+            self.add(expression_id, expression)
+
+    def add(self, expression_id, expression) -> None:
+        """
+        NOTE: This can raise a ValueError in the event that the expression was invalid or the id is already used.
+
+        Records that were already evaluated only get a result for the expression once they are evaluated again.
+        :param expression_id: A hashable id that results are reported under
+        :param expression: An input string or a StringBooleanExpression
+        """
+        if expression_id in self._trees:
+            raise ValueError(f"Duplicate expression id {expression_id}")
+
+        if not isinstance(expression, StringBooleanExpression):
+            expression = StringBooleanExpression.compile(expression, self._keyword_value_mapping)
+
+        self._trees[expression_id] = _IncrementalTree(expression._tree, frozenset(expression._variables))
+        for variable in expression._variables:
+            self._field_expressions.setdefault(variable, []).append(expression_id)
+
+    def evaluate(self, record_id, record: dict) -> dict:
+        """
+        NOTE: Like check, this can raise a ValueError if a field can not be cast to the type it is compared as.
+
+        Evaluates every expression against the record and caches the results under the record id, replacing anything
+        cached for it before
+        :param record_id: A hashable id of the record
+        :param record: The dictionary to contain the fields to look for
+        :return: A dictionary of expression id to result
+        """
+        cache = {expression_id: tree.evaluate(record, None, None) for expression_id, tree in self._trees.items()}
+        self._records[record_id] = cache
+        return {expression_id: values[0] for expression_id, values in cache.items()}
+
+    def update(self, record_id, record: dict, changed_fields) -> dict:
+        """
+        NOTE: Like check, this can raise a ValueError if a field can not be cast to the type it is compared as, and a
+              KeyError if the record was not evaluated before. If any expression raises nothing is updated, every
+              result is kept and the changed fields need to be passed to the next update again.
+
+        Re-evaluates the record after some of its fields changed, were added or were removed. Only the expressions and
+        nodes that depend on a changed field are evaluated again.
+        :param record_id: The id the record was evaluated under
+        :param record: The dictionary with the current fields of the record
+        :param changed_fields: The names of the fields that changed since the record was last evaluated or updated
+        :return: A dictionary of expression id to the new result for every result that flipped
+        """
+        cache = self._records[record_id]
+        changed_fields = frozenset(changed_fields)
+        affected = {expression_id for field in changed_fields for expression_id in self._field_expressions.get(field, ())}
+
+        flipped = {}
+        # The cached results and previous result of every expression evaluated so far
+        evaluated = []
+        try:
+            for expression_id in affected:
+                values = cache.get(expression_id)
+                if values is None:
+                    continue
+                result = values[0]
+                evaluated.append((values, result))
+                self._trees[expression_id].evaluate(record, values, changed_fields)
+                if values[0] != result:
+                    flipped[expression_id] = values[0]
+        except Exception:
+            # Restore the previous results, and evaluate every node again on the next update that affects them
+            for values, result in evaluated:
+                values[0] = result
+                values[1:] = [None] * (len(values) - 1)
+            raise
+        return flipped
+
+    def results(self, record_id) -> dict:
+        """
+        NOTE: This raises a KeyError if the record was not evaluated.
+
+        :return: A dictionary of expression id to the current result for the record
+        """
+        return {expression_id: values[0] for expression_id, values in self._records[record_id].items()}
+
+    def forget(self, record_id) -> None:
+        """
+        Drops the cached results of a record, does nothing if there are none
+        """
+        self._records.pop(record_id, None)
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+
+class _IncrementalTree:
+    """
+    An expression tree compiled for incremental evaluation. Every node has a position in a list of cached results, and
+    every And, Or and Not is compiled into a function that takes the record, the cached results and the changed
+    fields. It reuses the cached result of each operand that does not depend on a changed field, and evaluates and
+    caches the others. Comparisons are evaluated inline.
+    Position 0 is the result of the whole expression, which is False when the record is missing any of the fields,
+    and None marks a node that has to be evaluated.
+    """
+    __slots__ = ("variables", "size", "function")
+
+    def __init__(self, tree: Node, variables: frozenset):
+        self.variables = variables
+
+        # Comparisons are the leaves, so the nodes below them do not get positions
+        nodes = []
+        pending = [tree]
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            if not isinstance(node, Comparison):
+                pending.extend(reversed(node.children()))
+        positions = {id(node): position for position, node in enumerate(nodes, 1)}
+        self.size = len(nodes) + 1
+
+        namespace = {**_COMMAND_GLOBALS, "invalidate": _invalidate}
+        for node in nodes:
+            if not isinstance(node, Comparison):
+                function = self._set_up_node(node, list(node.children()), positions, namespace)
+                namespace[f"node{positions[id(node)]}"] = function
+
+        if isinstance(tree, Comparison):
+            # The function of the root caches the comparison at position 1 like an operand
+            self.function = self._set_up_node(None, [tree], positions, namespace)
+        else:
+            self.function = namespace["node1"]
+
+    def evaluate(self, record: dict, values: list, changed_fields) -> list:
+        """
+        :param record: The dictionary to contain the fields to look for
+        :param values: The cached results of the nodes, evaluated from scratch when None. The list is updated in place
+                       except for position 0, which is only set once the evaluation succeeded
+        :param changed_fields: The fields that changed since the values were cached
+        :return: The updated results of the nodes
+        """
+        if values is None:
+            values = [None] * self.size
+            changed_fields = frozenset()
+        if not record.keys() >= self.variables:
+            values[1:] = [None] * (len(values) - 1)
+            values[0] = False
+            return values
+
+        values[0] = self.function(record, values, changed_fields)
+        return values
+
+    @staticmethod
+    def _set_up_node(node, children: list, positions: dict, namespace: dict):
+        """
+        Compiles the function of a node, for an Or it looks like
+            value = values[2]
+            if value is None or not changed.isdisjoint(frozenset({"name"})):
+                value = str(record["name"]) == "bob"
+                values[2] = value
+            if value:
+                invalidate(values, changed, descendants, 1)
+                return True
+            ...
+            return False
+        :param node: An And, Or or Not, or None for the node above a root that is a comparison
+        :param children: The children of the node
+        :param positions: Maps the id of every node to its position
+        :param namespace: The globals of the function, with the functions of the child nodes added before they are
+                          called
+        :return: The compiled function
+        """
+        def load(name: str) -> ast.Name:
+            return ast.Name(id=name, ctx=ast.Load(), **_LOCATION)
+
+        def store(name: str) -> ast.Name:
+            return ast.Name(id=name, ctx=ast.Store(), **_LOCATION)
+
+        def call(function: str, arguments: list) -> ast.Call:
+            return ast.Call(func=load(function), args=arguments, keywords=[], **_LOCATION)
+
+        def constant(value) -> ast.Constant:
+            return ast.Constant(value=value, **_LOCATION)
+
+        # The (position, variables) pairs of every operand and its descendants, and where each operand starts
+        descendants = []
+        starts = []
+        for child in children:
+            starts.append(len(descendants))
+            descendants.extend((positions[id(descendant)], descendant.variables) for descendant in child.walk()
+                               if id(descendant) in positions)
+        starts.append(len(descendants))
+        # A global instead of a constant, since large constants that repeat are slow to compile
+        descendants_name = f"descendants{len(namespace)}"
+        namespace[descendants_name] = tuple(descendants)
+
+        statements = []
+        for index, child in enumerate(children):
+            position = positions[id(child)]
+            if isinstance(child, Comparison):
+                references = {(variable.name, variable.variable_type): lambda variable=variable: call(
+                    variable.variable_type, [_subscript(load("record"), variable.name)])
+                    for variable in child.walk() if isinstance(variable, Variable)}
+                value = child.to_python(references)
+            else:
+                value = call(f"node{position}", [load("record"), load("values"), load("changed")])
+
+            # value = values[position]
+            # if value is None or not changed.isdisjoint(variables): value = <child>; values[position] = value
+            statements.append(ast.Assign(targets=[store("value")], value=_subscript(load("values"), position),
+                                         **_LOCATION))
+            is_none = ast.Compare(left=load("value"), ops=[ast.Is()], comparators=[constant(None)], **_LOCATION)
+            isdisjoint = ast.Attribute(value=load("changed"), attr="isdisjoint", ctx=ast.Load(), **_LOCATION)
+            changed = ast.UnaryOp(op=ast.Not(), operand=ast.Call(func=isdisjoint, args=[constant(child.variables)],
+                                                                 keywords=[], **_LOCATION), **_LOCATION)
+            target = _subscript(load("values"), position)
+            target.ctx = ast.Store()
+            statements.append(ast.If(test=ast.BoolOp(op=ast.Or(), values=[is_none, changed], **_LOCATION), body=[
+                ast.Assign(targets=[store("value")], value=value, **_LOCATION),
+                ast.Assign(targets=[target], value=load("value"), **_LOCATION)], orelse=[], **_LOCATION))
+
+            if isinstance(node, _Junction):
+                # if value: invalidate(<the descendants of the later operands>); return True, the same for an And with
+                # not value and False
+                decisive = isinstance(node, Or)
+                body = [ast.Return(value=constant(decisive), **_LOCATION)]
+                if starts[index + 1] < len(descendants):
+                    body.insert(0, ast.Expr(value=call("invalidate", [load("values"), load("changed"),
+                                                                      load(descendants_name),
+                                                                      constant(starts[index + 1])]), **_LOCATION))
+                test = load("value") if decisive else ast.UnaryOp(op=ast.Not(), operand=load("value"), **_LOCATION)
+                statements.append(ast.If(test=test, body=body, orelse=[], **_LOCATION))
+
+        if isinstance(node, _Junction):
+            result = constant(not isinstance(node, Or))
+        elif isinstance(node, Not):
+            result = ast.UnaryOp(op=ast.Not(), operand=load("value"), **_LOCATION)
+        else:
+            result = load("value")
+        return _build_function(["record", "values", "changed"], statements, result, name="node", namespace=namespace)
+
+
+def _invalidate(values: list, changed_fields: frozenset, nodes: tuple, start: int) -> None:
+    """
+    Marks the nodes that depend on a changed field to be evaluated, used by the functions of _IncrementalTree for the
+    operands that short circuiting skipped, as their cached results are from before the change
+    :param values: The cached results of the nodes
+    :param changed_fields: The fields that changed
+    :param nodes: (position, variables) pairs
+    :param start: The index of the first pair in nodes to check
+    """
+    for position, variables in itertools.islice(nodes, start, None):
+        if not changed_fields.isdisjoint(variables):
+            values[position] = None
+
+
+class Dataset:
+    """
+    Holds a fixed collection of records in columns, to run many different expressions against.
+    Indexes are built the first time a field is compared as a type, a hash index for string fields and a sorted index
+    for float and int fields. A query looks up the rows that can match in the indexes, intersecting them for && and
+    uniting them for ||, and only checks those rows. Comparisons that can not use an index, like !=, !! and
+    comparisons between two fields, leave it to the check.
+    """
+
+    def __init__(self, records):
+        """
+        :param records: An iterable of dictionaries
+        """
+        self._columns = {}
+        self._length = 0
+        for position, record in enumerate(records):
+            for field, value in record.items():
+                column = self._columns.get(field)
+                if column is None:
+                    column = self._columns[field] = [_MISSING] * position
+                column.append(value)
+            self._length = position + 1
+            for column in self._columns.values():
+                if len(column) < self._length:
+                    column.append(_MISSING)
+
+        # Maps a field name to a dictionary of string value to the positions of the rows with the value
+        self._hash_indexes = {}
+        # Maps (field name, float or int) to the cast values in sorted order, the positions of the rows with them and
+        # the positions of the rows where the field can not be cast
+        self._sorted_indexes = {}
+
+    def query(self, expression) -> list:
+        """
+        NOTE: Like check, this can raise a ValueError if a field can not be cast to the type it is compared as.
+
+        :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+        :return: The positions of the matching records, in order
+        """
+        expression = _as_expression(expression)
+        if any(variable not in self._columns for variable in expression._variables):
+            return []
+
+        candidates = self._candidates(expression._tree)
+        if candidates is not None:
+            candidates = set(candidates)
+            # Rows with values that can not be cast are always checked, so they raise whenever checking every row would
+            for name, variable_type in {(node.name, node.variable_type) for node in expression._tree.walk()
+                                        if isinstance(node, Variable) and node.variable_type != STRING[1]}:
+                candidates.update(self._sorted_index(name, variable_type)[2])
+
+        columns = [self._columns[variable] for variable in expression._sorted_variables]
+        command = expression._command
+        positions = range(self._length) if candidates is None else sorted(candidates)
+        matches = []
+        for position in positions:
+            values = [column[position] for column in columns]
+            if _MISSING not in values and command(*values):
+                matches.append(position)
+        return matches
+
+    def select(self, expression) -> list:
+        """
+        NOTE: Like check, this can raise a ValueError if a field can not be cast to the type it is compared as.
+
+        :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+        :return: The matching records, in order
+        """
+        return [self[position] for position in self.query(expression)]
+
+    def __getitem__(self, position: int) -> dict:
+        return {field: column[position] for field, column in self._columns.items() if column[position] is not _MISSING}
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _candidates(self, node: Node):
+        """
+        :param node: A node of the expression tree
+        :return: A collection with the positions of every row the node can be True for, it can hold positions the node
+                 is False for, or None when the node can be True for any row
+        """
+        if isinstance(node, And):
+            operand_candidates = sorted((candidates for candidates in map(self._candidates, node.operands)
+                                         if candidates is not None), key=len)
+            if not operand_candidates:
+                return None
+            # Intersecting with an operand costs about as much as checking its rows, so operands with many more rows
+            # than the smallest are left to the check
+            candidates = operand_candidates[0]
+            for other in operand_candidates[1:]:
+                if len(other) > _INTERSECTION_RATIO * len(operand_candidates[0]):
+                    break
+                candidates = set(candidates).intersection(other)
+            return candidates
+        if isinstance(node, Or):
+            candidates = set()
+            for operand in node.operands:
+                operand_candidates = self._candidates(operand)
+                if operand_candidates is None:
+                    return None
+                candidates.update(operand_candidates)
+            return candidates
+        if isinstance(node, Comparison):
+            return self._comparison_candidates(node.oriented())
+        return None
+
+    def _comparison_candidates(self, comparison: Comparison):
+        """
+        :param comparison: A comparison with any variable on the left
+        :return: A list with the positions of the rows the comparison is True for, or None when no index can be used
+        """
+        if not isinstance(comparison.left, Variable) or not isinstance(comparison.right, Constant) or \
+                comparison.operator == "!=":
+            return None
+
+        name, variable_type, value = comparison.left.name, comparison.left.variable_type, comparison.right.value
+        if variable_type == STRING[1]:
+            if comparison.operator != "==":
+                return None
+            return self._hash_index(name).get(value, [])
+
+        keys, positions, _ = self._sorted_index(name, variable_type)
+        operator = _COMPARISON_OPERATORS[comparison.operator]
+        if operator is ast.Eq:
+            return positions[bisect.bisect_left(keys, value):bisect.bisect_right(keys, value)]
+        if operator is ast.Lt:
+            return positions[:bisect.bisect_left(keys, value)]
+        if operator is ast.LtE:
+            return positions[:bisect.bisect_right(keys, value)]
+        if operator is ast.Gt:
+            return positions[bisect.bisect_right(keys, value):]
+        return positions[bisect.bisect_left(keys, value):]
+
+    def _hash_index(self, name: str) -> dict:
+        """
+        :return: A dictionary of the string value of the field to the positions of the rows with it
+        """
+        index = self._hash_indexes.get(name)
+        if index is None:
+            index = {}
+            for position, value in enumerate(self._columns[name]):
+                if value is not _MISSING:
+                    index.setdefault(str(value), []).append(position)
+            self._hash_indexes[name] = index
+        return index
+
+    def _sorted_index(self, name: str, variable_type: str) -> tuple:
+        """
+        :return: The values of the field cast to the type in sorted order, the positions of the rows with them and the
+                 positions of the rows where the field can not be cast. NaN is left out, as it is never equal to,
+                 less than or greater than anything.
+        """
+        index = self._sorted_indexes.get((name, variable_type))
+        if index is None:
+            cast = CASTS[variable_type]
+            pairs = []
+            invalid = []
+            for position, value in enumerate(self._columns[name]):
+                if value is _MISSING:
+                    continue
+                try:
+                    value = cast(value)
+                except Exception:
+                    invalid.append(position)
+                    continue
+                if value == value:
+                    pairs.append((value, position))
+            pairs.sort()
+            index = [value for value, _ in pairs], [position for _, position in pairs], invalid
+            self._sorted_indexes[(name, variable_type)] = index
+        return index
+
+
+def filter_stream(expression, records, batch_size: int = 1024):
+    """
+    Yields the records that match the expression. The records are read and evaluated with check_many in batches of
+    batch_size, so memory use is bounded by the batch size and not by the number of records.
+    :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+    :param records: An iterable of dictionaries
+    :param batch_size: The number of records that are evaluated together
+    """
+    expression = _as_expression(expression)
+    return _filter_batches(expression, records, _record_decoder(expression, None), batch_size)
+
+
+def filter_jsonl(expression, lines, batch_size: int = 1024):
+    """
+    NOTE: This raises a ValueError for a line that is not valid JSON, unless the line is skipped without being decoded
+          because it can not contain every field of the expression.
+
+    Yields the lines, each a JSON object, that match the expression. Blank lines and lines that are not objects never
+    match. A line that can not contain every field of the expression is skipped without being decoded, and only the
+    fields of the expression are kept from the lines that are decoded.
+    :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+    :param lines: An iterable of strings, for example an open file
+    :param batch_size: The number of lines that are evaluated together
+    """
+    expression = _as_expression(expression)
+    return _filter_batches(expression, lines, _record_decoder(expression, "jsonl"), batch_size)
+
+
+def filter_csv(expression, rows, header: list):
+    """
+    Yields the CSV rows that match the expression, the rows are checked with a function from bind so only the columns
+    used by the expression are read from each row. A row that is shorter than the header is missing the fields past
+    its end.
+    :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+    :param rows: An iterable of rows as lists of strings without the header, for example a csv.reader after the header
+    :param header: The field names of the columns
+    """
+    return filter(_as_expression(expression).bind(header), rows)
+
+
+def filter_sqlite(expression, connection, table: str, columns: list = None):
+    """
+    Yields the rows of a SQLite table that match the expression. The expression is translated with to_sql and run
+    inside the database, so indexes can be used and rows that do not match are never read into Python. The rows are
+    streamed from the cursor, in the form set by the row_factory of the connection.
+    A field that is not a column of the table never matches, the same as a field missing from a record in check.
+    :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+    :param connection: A sqlite3 connection
+    :param table: The name of the table
+    :param columns: The names of the columns to select, all of them when None
+    """
+    expression = _as_expression(expression)
+    table = _quote_identifier(table)
+    # The rows of table_info are (cid, name, type, notnull, dflt_value, pk)
+    column_affinities = {row[1]: _sqlite_affinity(row[2])
+                         for row in connection.execute(f"PRAGMA table_info({table})").fetchall()}
+    if not column_affinities:
+        raise ValueError(f"Unknown table ({table}).")
+    if any(variable not in column_affinities for variable in expression._variables):
+        return iter(())
+
+    selected = "*" if columns is None else ", ".join(_quote_identifier(column) for column in columns)
+    condition, parameters = expression.to_sql(column_affinities)
+    return iter(connection.execute(f"SELECT {selected} FROM {table} WHERE {condition}", parameters))
+
+
+def _quote_identifier(name: str) -> str:
+    """
+    :return: The name quoted as a SQL identifier
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sqlite_affinity(declared_type: str) -> str:
+    """
+    Finds the affinity of a column from its declared type, following the rules SQLite uses
+    :param declared_type: The type of the column in its CREATE TABLE statement, can be empty
+    :return: TEXT, NUMERIC, INTEGER, REAL or BLOB
+    """
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return "INTEGER"
+    if any(text in declared_type for text in ["CHAR", "CLOB", "TEXT"]):
+        return "TEXT"
+    if "BLOB" in declared_type or not declared_type:
+        return "BLOB"
+    if any(real in declared_type for real in ["REAL", "FLOA", "DOUB"]):
+        return "REAL"
+    return "NUMERIC"
+
+
+def _filter_batches(expression: StringBooleanExpression, items, decode, batch_size: int):
+    """
+    Yields the items that match the expression
+    :param expression: The expression to match
+    :param items: An iterable of records in any format
+    :param decode: Turns a list of items into a list of dictionaries, see _record_decoder
+    :param batch_size: The number of items that are evaluated together
+    """
+    for batch in _batches(items, batch_size):
+        for item, matched in zip(batch, expression.check_many(decode(batch))):
+            if matched:
+                yield item
+
+
+def _record_decoder(expression: StringBooleanExpression, record_format):
+    """
+    :param expression: The expression the records are decoded for, only its fields are decoded
+    :param record_format: None for dictionaries or "jsonl" for lines with a JSON object
+    :return: A function that turns a list of records in the format into a list of dictionaries
+    """
+    variables = expression._sorted_variables
+
+    if record_format is None:
+        return lambda records: records
+
+    if record_format == "jsonl":
+        keys = [json.dumps(variable, ensure_ascii=False) for variable in variables]
+
+        def decode_line(line: str) -> dict:
+            # A key could be written with escape sequences, so only lines without any are skipped undecoded
+            if (any(key not in line for key in keys) and "\\" not in line) or not line.strip():
+                return {}
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                return {}
+            return {variable: record[variable] for variable in variables if variable in record}
+
+        return lambda lines: [decode_line(line) for line in lines]
+
+    raise ValueError(f"Unknown record format ({record_format}).")
+
+
+def _chunk_checker(expression: StringBooleanExpression, record_format, header):
+    """
+    :param expression: The expression to match
+    :param record_format: None for dictionaries, "jsonl" for lines with a JSON object or "csv" for CSV rows
+    :param header: The field names of the columns of CSV rows
+    :return: A function that takes a list of records in the format and returns whether each of them matches
+    """
+    if record_format == "csv":
+        bound = expression.bind(header)
+        return lambda rows: [bound(row) for row in rows]
+
+    decode = _record_decoder(expression, record_format)
+    return lambda records: [bool(matched) for matched in expression.check_many(decode(records))]
+
+
+def check_parallel(expression, records, processes: int = None, chunk_size: int = 10000, record_format=None,
+                   header: list = None):
+    """
+    Yields whether each record matches the expression, in input order. The records are split into chunks that are
+    evaluated with check_many in a pool of processes. Each process compiles the expression once from its serialized
+    form, and only a few chunks are in flight at a time so memory use stays bounded.
+    :param expression: A StringBooleanExpression, or an input string that is compiled with StringBooleanExpression.compile
+    :param records: An iterable of records, for example a list of dictionaries or an open JSON lines file
+    :param processes: The number of processes, os.cpu_count() when None
+    :param chunk_size: The number of records sent to a process at a time
+    :param record_format: None for dictionaries, "jsonl" for lines with a JSON object or "csv" for CSV rows, lines and
+                          rows are decoded in the processes
+    :param header: The field names of the columns of CSV rows
+    """
+    for _, mask in _check_parallel_chunks(expression, records, processes, chunk_size, record_format, header):
+        yield from mask
+
+
+def count_parallel(expression, records, processes: int = None, chunk_size: int = 10000, record_format=None,
+                   header: list = None) -> int:
+    """
+    Counts the records that match the expression, the same as check_parallel
+    :return: The number of records that match
+    """
+    return sum(sum(mask) for _, mask in _check_parallel_chunks(expression, records, processes, chunk_size,
+                                                               record_format, header))
+
+
+def _check_parallel_chunks(expression, records, processes, chunk_size: int, record_format, header):
+    """
+    Yields each chunk of records and the list of whether each of them matched, in input order
+    """
+    expression = _as_expression(expression)
+    processes = processes or os.cpu_count() or 1
+    # Raises for an unknown format before any process is started
+    _chunk_checker(expression, record_format, header)
+
+    with multiprocessing.Pool(processes, _initialize_worker,
+                              (expression.serialize(), record_format, header)) as pool:
+        pending = deque()
+        for chunk in _batches(records, chunk_size):
+            pending.append((chunk, pool.apply_async(_check_chunk, (chunk,))))
+            if len(pending) > 2 * processes:
+                chunk, result = pending.popleft()
+                yield chunk, result.get()
+
+        while pending:
+            chunk, result = pending.popleft()
+            yield chunk, result.get()
+
+
+# Set up in each process of the pool used by check_parallel
+_worker_check = None
+
+
+def _initialize_worker(serialized_expression: tuple, record_format, header) -> None:
+    """
+    Compiles the expression once for the process
+    """
+    global _worker_check
+    _worker_check = _chunk_checker(StringBooleanExpression.deserialize(serialized_expression), record_format, header)
+
+
+def _check_chunk(chunk: list) -> list:
+    """
+    :return: Whether each record in the chunk matches the expression of the process
+    """
+    return _worker_check(chunk)
+
+
+def _as_expression(expression) -> StringBooleanExpression:
+    """
+    :param expression: A StringBooleanExpression or an input string
+    :return: The expression, input strings are compiled with StringBooleanExpression.compile
+    """
+    if isinstance(expression, StringBooleanExpression):
+        return expression
+    return StringBooleanExpression.compile(expression)
+
+
+def _batches(iterable, batch_size: int):
+    """
+    Yields lists of up to batch_size items from the iterable
+    """
+    if batch_size < 1:
+        raise ValueError(f"The batch size must be at least 1: {batch_size}")
+
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, batch_size))
+
+
+def main(argv=None) -> int:
+    """
+    Filters JSON lines or CSV rows from files or stdin to stdout, run with python -m stringbooleanexpression --help
+    :param argv: The command line arguments, sys.argv is used when None
+    :return: The exit code, 0 if anything matched and 1 otherwise like grep. It exits with 2 for a line that can not
+             be decoded or has a value that can not be cast.
+    """
+    parser = argparse.ArgumentParser(prog="python -m stringbooleanexpression",
+                                     description="Writes the JSON lines or CSV rows that match a string boolean "
+                                                 "expression to stdout.")
+    parser.add_argument("expression", help="The expression to match, for example S$name==bob||F$salary<<20.5")
+    parser.add_argument("files", nargs="*", default=["-"], help="The files to read, - or nothing reads stdin")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl",
+                        help="The input format, CSV files need a header row (default: jsonl)")
+    parser.add_argument("-c", "--count", action="store_true", help="Only write the number of matches")
+    parser.add_argument("-m", "--max-matches", type=int, metavar="N", help="Stop reading after N matches")
+    parser.add_argument("--batch-size", type=int, default=1024, help="The number of records evaluated together")
+    parser.add_argument("-p", "--processes", type=int, metavar="N",
+                        help="Evaluate batches in a pool of N processes, 0 uses every core")
+    arguments = parser.parse_args(argv)
+    for option, value, minimum in [("--max-matches", arguments.max_matches, 0), ("--batch-size", arguments.batch_size, 1),
+                                   ("--processes", arguments.processes, 0)]:
+        if value is not None and value < minimum:
+            parser.error(f"{option} must be at least {minimum}: {value}")
+
+    try:
+        expression = StringBooleanExpression(arguments.expression)
+    except ValueError as error:
+        parser.error(str(error))
+
+    csv_writer = csv.writer(sys.stdout, lineterminator="\n")
+    headers = []
+
+    def filter_input(path, items, line_number, header):
+        # The items that have been read but not yet checked, with the line number each of them ends on
+        pending = deque()
+
+        def read():
+            for item in items:
+                pending.append((line_number(), item))
+                yield item
+
+        check = _chunk_checker(expression, arguments.format, header)
+        if arguments.processes is None:
+            chunks = ((chunk, check(chunk)) for chunk in _batches(read(), arguments.batch_size))
+        else:
+            chunks = _check_parallel_chunks(expression, read(), arguments.processes, arguments.batch_size,
+                                            arguments.format, header)
+        try:
+            for chunk, mask in chunks:
+                for item, matched in zip(chunk, mask):
+                    pending.popleft()
+                    if matched:
+                        yield item
+        except (ValueError, TypeError) as error:
+            # The chunk that failed is at the start of pending, its items are checked one at a time to find the line
+            for number, item in itertools.islice(pending, arguments.batch_size):
+                try:
+                    check([item])
+                except (ValueError, TypeError) as item_error:
+                    parser.exit(2, f"{parser.prog}: error: {path} line {number}: {item_error}\n")
+            parser.exit(2, f"{parser.prog}: error: {path}: {error}\n")
+
+    def find_matches():
+        for path in arguments.files:
+            try:
+                with _open_input(path) as input_file:
+                    if arguments.format == "jsonl":
+                        yield from filter_input(path, input_file, itertools.count(1).__next__, None)
+                        continue
+
+                    reader = csv.reader(input_file)
+                    header = next(reader, None)
+                    if header is not None:
+                        if not headers and not arguments.count:
+                            csv_writer.writerow(header)
+                        headers.append(header)
+                        yield from filter_input(path, reader, lambda: reader.line_num, header)
+            except OSError as error:
+                parser.exit(2, f"{parser.prog}: error: {error}\n")
+            except (ValueError, csv.Error) as error:
+                # The input could not be read, for example it is not UTF-8
+                parser.exit(2, f"{parser.prog}: error: {path}: {error}\n")
+
+    matches = find_matches()
+    if arguments.max_matches is not None:
+        matches = itertools.islice(matches, arguments.max_matches)
+
+    count = 0
+    for match in matches:
+        count += 1
+        if arguments.count:
+            continue
+        if arguments.format == "jsonl":
+            sys.stdout.write(match if match.endswith("\n") else match + "\n")
+        else:
+            csv_writer.writerow(match)
+
+    if arguments.count:
+        print(count)
+    return 0 if count else 1
+
+
+def _open_input(path: str):
+    """
+    :param path: A file path, or - for stdin
+    :return: A context manager for the opened file, stdin is not closed
+    """
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(path, encoding="utf-8", newline="")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
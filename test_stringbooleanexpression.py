@@ -1,5 +1,14 @@
-from unittest import TestCase
-from stringbooleanexpression import StringBooleanExpression
+import io
+import marshal
+import os
+import pickle
+import sqlite3
+import tempfile
+from unittest import TestCase, mock, skipIf
+import stringbooleanexpression
+from stringbooleanexpression import StringBooleanExpression, And, Comparison, ExpressionCache, Not, Or, RuleSet, \
+    IncrementalEvaluator, Dataset, MAX_NESTING, load_rules, find_duplicate_rules, RULE_CACHE_SUFFIX, filter_stream, \
+    filter_jsonl, filter_csv, filter_sqlite, check_parallel, count_parallel, main
 
 
 class TestStringBooleanExpression(TestCase):
@@ -60,48 +69,398 @@ class TestStringBooleanExpression(TestCase):
         self.assertTrue(complex_example.check({"name": "something with a space", "salary": 0}),
                         "Checking complex space true case")
 
+    def test_bind(self):
+        expression = StringBooleanExpression("S$name==bob||F$salary>>10&&F$salary<<100")
+        bound = expression.bind(["id", "name", "salary"])
+        for row in [(1, "bob", "5"), (1, "jim", "50"), (1, "jim", "500"), [2, "bob", 0], (1, "bob"), ()]:
+            record = dict(zip(["id", "name", "salary"], row))
+            self.assertEqual(bound(row), expression.check(record), f"Matches check for {row}")
+
+        self.assertFalse(expression.bind(["name"])(("bob",)), "A field missing from the schema never matches")
+        self.assertTrue(StringBooleanExpression("S$name==bob").bind(["name", "name"])(("bob", "jim")),
+                        "The first of repeated fields is used")
+        self.assertTrue(expression.bind(["name", "salary"], strict=True)(("bob", "1")))
+
+        with self.assertRaises(ValueError):
+            expression.bind(["name"], strict=True)
+        with self.assertRaises(IndexError):
+            expression.bind(["name", "salary"], strict=True)(("jim",))
+
+    def test_short_circuit_casts(self):
+        # A value that can not be cast only raises when the comparison that uses it is evaluated, like before casts of
+        # repeated variables were hoisted
+        expression = StringBooleanExpression("S$a==x||(F$b>>1&&F$b<<5)")
+        self.assertTrue(expression.check({"a": "x", "b": "junk"}))
+        self.assertTrue(expression.bind(["a", "b"])(("x", "junk")))
+        with self.assertRaises(ValueError):
+            expression.check({"a": "y", "b": "junk"})
+
+        # The first operand is always evaluated, so its casts are still hoisted
+        self.assertEqual(len(StringBooleanExpression._hoist_casts(StringBooleanExpression(
+            "F$b>>1&&S$a==x||F$b<<5")._tree, lambda name: name, lambda name, variable_type: name)[0]), 1)
+
+    def test_to_sql(self):
+        expression = StringBooleanExpression("S$name==bob||!!(F$salary>>10&&I$age<=EMPTY_STRING2)||S$name!=S$other",
+                                             {"EMPTY_STRING2": "2"})
+        self.assertEqual(expression.to_sql(),
+                         ('"age" IS NOT NULL AND "name" IS NOT NULL AND "other" IS NOT NULL AND "salary" IS NOT NULL AND '
+                          '(CAST("name" AS TEXT) = ? OR NOT (CAST("salary" AS REAL) > ? AND CAST("age" AS INTEGER) <= ?) '
+                          'OR CAST("name" AS TEXT) <> CAST("other" AS TEXT))', ["bob", 10.0, 2]))
+        self.assertEqual(expression.to_sql({"name": "TEXT", "salary": "INTEGER", "age": "REAL"})[0],
+                         '"age" IS NOT NULL AND "name" IS NOT NULL AND "other" IS NOT NULL AND "salary" IS NOT NULL AND '
+                         '("name" = ? OR NOT (("salary" > ? AND typeof("salary") IN (\'integer\', \'real\')) AND '
+                         'CAST("age" AS INTEGER) <= ?) OR "name" <> CAST("other" AS TEXT))',
+                         "TEXT columns compared as strings are not cast, numeric columns compared as floats are guarded")
+        self.assertEqual(StringBooleanExpression("!!bob==S$name").to_sql(),
+                         ('"name" IS NOT NULL AND NOT (? = CAST("name" AS TEXT))', ["bob"]))
+
+    def test_instrumentation(self):
+        expression = StringBooleanExpression("S$name==bob||(F$salary>>10&&!!S$name==jim)")
+        with self.assertRaises(ValueError):
+            expression.stats()
+
+        expression.enable_instrumentation()
+        expression.enable_instrumentation()
+        records = [{"name": "bob", "salary": 1}, {"name": "al", "salary": 50}, {"name": "jim", "salary": 50},
+                   {"salary": 1}]
+        results = [expression.check(record) for record in records]
+        self.assertEqual(results, [True, True, False, False])
+
+        stats = expression.stats()
+        self.assertEqual((stats.evaluations, stats.missing_fields), (4, 1))
+        self.assertGreater(stats.total_time, 0)
+        self.assertEqual(stats.comparisons, [("S$name==bob", 1, 2), ("F$salary>>10.0", 2, 0), ("S$name==jim", 1, 1)])
+
+        expression.reset_stats()
+        self.assertEqual(expression.stats(), (0, 0.0, 0, [("S$name==bob", 0, 0), ("F$salary>>10.0", 0, 0),
+                                                          ("S$name==jim", 0, 0)]))
+
+        expression.disable_instrumentation()
+        self.assertNotIn("check", vars(expression), "check is the uninstrumented method again")
+        self.assertTrue(expression.check({"name": "bob", "salary": 1}))
+        with self.assertRaises(ValueError):
+            expression.stats()
+
+    def test_adaptive_ordering(self):
+        input_string = "(F$salary>>1&&F$salary<<5&&I$age>=3)||!!S$name==bob||I$age==1&&S$name==al"
+        expected = StringBooleanExpression(input_string)
+        expression = StringBooleanExpression(input_string)
+        command = expression._command
+        expression.enable_adaptive_ordering(sample_size=10)
+
+        records = [{"salary": str(index % 7), "age": index % 4, "name": ["bob", "al", "jim"][index % 3]}
+                   for index in range(40)]
+        # A record can raise for one order of the operands and resolve for another, these raise in both
+        records += [{"salary": "x", "age": "x", "name": "bob"}, {"salary": "2", "age": "x", "name": "bob"},
+                    {"salary": "2"}]
+        for record in records:
+            try:
+                result = expected.check(record)
+            except ValueError:
+                with self.assertRaises(ValueError, msg=f"Raises for {record}"):
+                    expression.check(record)
+            else:
+                self.assertEqual(expression.check(record), result, f"Matches check for {record}")
+
+        self.assertEqual(str(expression._adaptive_ordering.tree),
+                         "!!S$name==bob||S$name==al&&I$age==1||I$age>=3&&F$salary>>1.0&&F$salary<<5.0")
+
+        expression.disable_adaptive_ordering()
+        self.assertIs(expression._command, command)
+        self.assertIsNone(expression._adaptive_ordering)
+
+        with self.assertRaises(ValueError):
+            expression.enable_adaptive_ordering(sample_size=0)
+
+    def test_canonical(self):
+        equivalent = ["S$name==bob&&F$salary>>10", "bob==S$name&&10<<F$salary", "(F$salary>>10&&S$name==bob)",
+                      "F$salary>>10&&(S$name==bob&&S$name==bob)", "!!!!S$name==bob&&F$salary>>10"]
+        for input_string in equivalent[1:]:
+            self.assertEqual(StringBooleanExpression(input_string), StringBooleanExpression(equivalent[0]),
+                             input_string)
+            self.assertEqual(hash(StringBooleanExpression(input_string)), hash(StringBooleanExpression(equivalent[0])))
+        self.assertEqual(len(set(map(StringBooleanExpression, equivalent))), 1)
+
+        self.assertNotEqual(StringBooleanExpression("S$name==bob"), StringBooleanExpression("S$name!=bob"))
+        self.assertNotEqual(StringBooleanExpression("I$age==1"), StringBooleanExpression("F$age==1"))
+        self.assertEqual(StringBooleanExpression("F$a<=F$b"), StringBooleanExpression("F$b>=F$a"))
+        self.assertEqual(StringBooleanExpression("F$a==nan"), StringBooleanExpression("F$a==nan"))
+
+        # Only the negation of a float equality is a comparison, !!F$a<<1 is True for NaN but F$a>=1 is not
+        self.assertEqual(str(StringBooleanExpression("!!S$a<<b||!!F$a==1||!!F$a<<1")._tree.canonical()),
+                         "!!F$a<<1.0||F$a!=1.0||S$a>=b")
+
+    def test_simplify(self):
+        cases = {
+            "F$x>>10||F$x>>20": "F$x>>10.0",
+            "F$x>>10&&F$x>>20": "F$x>>20.0",
+            "F$x>>10||F$x==10": "F$x>=10.0",
+            "I$x>=10&&I$x<=10": "I$x==10",
+            "I$x>=10&&I$x!=10&&I$x<<20": "I$x<<20&&I$x>>10",
+            "S$a==b||(S$a==b&&S$c==d)": "S$a==b",
+            "S$a==b&&(S$a==b||S$c==d)": "S$a==b",
+            "F$x>>10||(F$x>>20&&S$c==d)": "F$x>>10.0",
+            "F$x==nan||F$x>=nan": "F$x==nan||F$x>=nan",
+            "F$x>>10||F$x<<20": "F$x<<20.0||F$x>>10.0",
+        }
+        for input_string, simplified in cases.items():
+            self.assertEqual(str(StringBooleanExpression(input_string)._tree.simplified()), simplified, input_string)
+
+        # The simplified expression keeps the fields of the original one
+        expression = StringBooleanExpression("S$a==b||(S$a==b&&S$c==d)")
+        simplified = expression.simplify()
+        self.assertEqual(simplified._tree.variables, {"a"})
+        for record in [{"a": "b"}, {"a": "b", "c": "e"}, {"a": "c", "c": "d"}]:
+            self.assertEqual(simplified.check(record), expression.check(record), record)
+        self.assertEqual(pickle.loads(pickle.dumps(simplified)).check({"a": "b"}), False)
+
+    def test_check_many(self):
+        complex_example = StringBooleanExpression(
+            "something with a space==S$name||"
+            "(S$name==bob||jim==S$name||(EMPTY_STRING==S$name&&S$name==EMPTY_STRING&&F$salary>=10.5))")
+        records = [{"name": "", "salary": 0}, {"name": "", "salary": 10.5}, {"name": "bob"},
+                   {"name": "jim", "salary": 0}, {"name": "something with a space", "salary": 0}, {}]
+        expected = [complex_example.check(record) for record in records]
+
+        for numpy_module in [stringbooleanexpression.numpy, None]:
+            with mock.patch("stringbooleanexpression.numpy", numpy_module):
+                self.assertEqual(list(complex_example.check_many(records)), expected, "Matches check on records")
+                self.assertEqual(list(complex_example.check_many({"name": ["bob", "", ""], "salary": [0, 0, 11]})),
+                                 [True, False, True], "Columnar input")
+                self.assertEqual(list(complex_example.check_many({"name": ["bob", "jim"]})), [False, False],
+                                 "Missing column resolves to False")
+                self.assertEqual(list(complex_example.check_many([])), [], "Empty input")
+
+                not_example = StringBooleanExpression("!!(S$name==bob)&&I$age<<30")
+                self.assertEqual(list(not_example.check_many({"name": ["bob", "jim", "jim"], "age": [1, "2", 40]})),
+                                 [False, True, False], "Not operator and casting")
+
+                # Values are cast like check does, and a field that check does not reach does not raise
+                cases = {"S$x==1": [{"x": 1}, {"x": 2.5}], "S$x==True": [{"x": True}, {"x": 1}],
+                         "F$x>>1": [{"x": 2}, {"x": 0.5}], "S$x==ab": [{"x": "ab\x00"}, {"x": "ab"}],
+                         "S$a==x||F$b>>1": [{"a": "x", "b": "junk"}, {"a": "y", "b": 2}]}
+                for input_string, case_records in cases.items():
+                    expression = StringBooleanExpression(input_string)
+                    self.assertEqual(list(expression.check_many(case_records)),
+                                     [expression.check(record) for record in case_records], input_string)
+                with self.assertRaises(ValueError):
+                    StringBooleanExpression("I$x<<0").check_many([{"x": float("nan")}])
+                with self.assertRaises(TypeError):
+                    StringBooleanExpression("F$x>>1").check_many({"x": [None]})
+
+        with self.assertRaises(ValueError):
+            complex_example.check_many({"name": ["bob"], "salary": [1, 2]})
+
+    @skipIf(stringbooleanexpression.numpy is None, "NumPy is not installed")
+    def test_check_many_numpy(self):
+        numpy = stringbooleanexpression.numpy
+        expression = StringBooleanExpression("F$salary>=10.5||S$name==bob")
+        mask = expression.check_many({"salary": numpy.array([1.0, 20.0, 3.0]), "name": numpy.array(["a", "b", "bob"])})
+        self.assertEqual(mask.dtype, numpy.bool_)
+        self.assertEqual(mask.tolist(), [False, True, True])
+
+        # A float32 column compares like the Python float it is cast to
+        mask = expression.check_many({"salary": numpy.array([10.5, 0.1], dtype=numpy.float32), "name": ["a", "b"]})
+        self.assertEqual(mask.tolist(), [True, False])
+        self.assertFalse(StringBooleanExpression("F$salary==0.1").check_many(
+            {"salary": numpy.array([0.1], dtype=numpy.float32)})[0])
+
+    def test_compile(self):
+        StringBooleanExpression.compile_cache.clear()
+        expression = StringBooleanExpression.compile("S$name==bob")
+
+        self.assertTrue(expression.check({"name": "bob"}))
+        self.assertIs(StringBooleanExpression.compile("S$name==bob"), expression, "Repeated strings are cached")
+        self.assertIs(StringBooleanExpression.compile("S$name==bob", {"EMPTY_STRING": ""}), expression,
+                      "The default keyword mapping is the same as passing None")
+        self.assertIsNot(StringBooleanExpression.compile("S$name==bob", {"OTHER": "x"}), expression,
+                         "The keyword mapping is part of the key")
+        self.assertEqual(StringBooleanExpression.compile_cache.stats(), (2, 2, 0, 2, 1024))
+
+        with self.assertRaises(ValueError):
+            StringBooleanExpression.compile("eval()")
+
+        StringBooleanExpression.compile_cache.clear()
+        self.assertEqual(StringBooleanExpression.compile_cache.stats(), (0, 0, 0, 0, 1024))
+
+    def test_expression_cache(self):
+        cache = ExpressionCache(max_size=2)
+        first = cache.get("S$name==a")
+        cache.get("S$name==b")
+        self.assertIs(cache.get("S$name==a"), first)
+
+        # S$name==b is now the least recently used
+        cache.get("S$name==c")
+        self.assertEqual(cache.stats(), (1, 3, 1, 2, 2))
+        self.assertIs(cache.get("S$name==a"), first)
+
+        cache.max_size = 1
+        self.assertEqual(cache.stats().evictions, 2)
+        self.assertEqual(len(cache), 1)
+
+        cache.max_size = 0
+        cache.get("S$name==a")
+        self.assertEqual(len(cache), 0, "A max size of zero disables caching")
+        self.assertEqual(cache.stats(), (2, 4, 3, 0, 0), "Misses are not evictions when caching is disabled")
+
+        # The default keyword mapping is copied, so changing the shared default does not change cached expressions
+        self.assertIsNot(cache.get("S$name==a")._keyword_value_mapping, stringbooleanexpression.DEFAULT_KEYWORD_VALUE_MAPPING)
+
+        with self.assertRaises(ValueError):
+            cache.max_size = -1
+
+    def test_serialize(self):
+        expression = StringBooleanExpression("S$name==TESTING||!!(F$salary>=10.5&&I$age<<30)", {"TESTING": "bob"})
+        records = [{"name": "bob", "salary": 0, "age": 0}, {"name": "", "salary": 20, "age": 20},
+                   {"name": "", "salary": 0, "age": 20}, {"name": "bob"}]
+
+        serialized = expression.serialize()
+        self.assertEqual(serialized[1], (("TESTING", "bob"),))
+        self.assertEqual(serialized[2], ("age", "name", "salary"))
+
+        for copy in [StringBooleanExpression.deserialize(serialized), pickle.loads(pickle.dumps(expression))]:
+            self.assertEqual(copy.serialize(), serialized)
+            self.assertEqual(str(copy._tree), str(expression._tree))
+            self.assertEqual([copy.check(record) for record in records],
+                             [expression.check(record) for record in records])
+
+    def test_load_rules(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rules.txt")
+            with open(path, "w") as rules_file:
+                rules_file.write("S$name==bob\n\nF$salary>=10.5||S$name==EMPTY_STRING\r\n")
+
+            for _ in range(2):
+                expressions = load_rules(path)
+                self.assertTrue(os.path.exists(path + RULE_CACHE_SUFFIX), "The cache file is written")
+                self.assertEqual(len(expressions), 2)
+                self.assertEqual([expression.check({"name": "", "salary": 1}) for expression in expressions],
+                                 [False, True])
+
+            # A cached expression is the same as a parsed one
+            cached = load_rules(path)[1]
+            self.assertEqual(cached.serialize(), StringBooleanExpression("F$salary>=10.5||S$name==EMPTY_STRING")
+                             .serialize())
+
+            # The cache is keyed on the keyword mapping and the content
+            self.assertFalse(load_rules(path, {"EMPTY_STRING": "bob"})[1].check({"name": "", "salary": 1}))
+            with open(path, "w") as rules_file:
+                rules_file.write("S$name==jim\n")
+            self.assertTrue(load_rules(path)[0].check({"name": "jim"}))
+
+            with open(path + RULE_CACHE_SUFFIX, "wb") as cache_file:
+                cache_file.write(b"corrupt")
+            self.assertTrue(load_rules(path)[0].check({"name": "jim"}), "A corrupt cache file is replaced")
+
+            # The cache file only holds the serialized expressions, and entries that are not valid trees are rebuilt
+            with open(path + RULE_CACHE_SUFFIX, "rb") as cache_file:
+                key, rules = marshal.loads(cache_file.read())
+            self.assertEqual(rules, [StringBooleanExpression("S$name==jim").serialize()])
+            for tree in [("Unknown",), ("Variable", "name", "eval"), ("Constant", ("code",)),
+                         ("Comparison", "+", ("Variable", "name", "S"), ("Constant", "jim"))]:
+                with open(path + RULE_CACHE_SUFFIX, "wb") as cache_file:
+                    cache_file.write(marshal.dumps((key, [rules[0][:3] + (tree,)])))
+                self.assertEqual(load_rules(path)[0].to_sql(),
+                                 ('"name" IS NOT NULL AND CAST("name" AS TEXT) = ?', ["jim"]), tree)
+
+            # The temporary file is removed when the cache file can not be written
+            with mock.patch("os.replace", side_effect=OSError):
+                load_rules(path, {"EMPTY_STRING": "x"})
+            self.assertEqual(sorted(os.listdir(directory)), ["rules.txt", "rules.txt" + RULE_CACHE_SUFFIX])
+
+            # The cache is keyed on its format version
+            with mock.patch.object(stringbooleanexpression, "_RULE_CACHE_VERSION", -1):
+                with mock.patch.object(stringbooleanexpression, "_read_rule_cache", return_value=None) as read:
+                    load_rules(path)
+            self.assertNotEqual(read.call_args[0][1], key)
+
+            os.remove(path + RULE_CACHE_SUFFIX)
+            load_rules(path, use_cache=False)
+            self.assertFalse(os.path.exists(path + RULE_CACHE_SUFFIX))
+
+    def test_find_duplicate_rules(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rules.txt")
+            with open(path, "w") as rules_file:
+                rules_file.write("S$name==bob&&F$salary>>10\nS$name==jim\n\n(F$salary>>20||F$salary>>10)&&bob==S$name\n"
+                                 "S$name==EMPTY_STRING\nS$name==jim||(S$name==jim&&S$a==b)\n")
+            self.assertEqual(find_duplicate_rules(path), [[1, 4]])
+            self.assertEqual(find_duplicate_rules(path, {"EMPTY_STRING": "jim"}), [[1, 4], [2, 5]])
+
+            with open(path, "a") as rules_file:
+                rules_file.write("S$name==\n")
+            with self.assertRaisesRegex(ValueError, "Line 7"):
+                find_duplicate_rules(path)
+
     def test__set_up_function(self):
         # Testing the setup function
         variables = ["var_one", "var_two"]
-        example_equal_expression = "var_one == var_two"
+        example_equal_expression, _ = StringBooleanExpression._parse_input("S$var_one==S$var_two", {})
 
         function = StringBooleanExpression._set_up_function(example_equal_expression, variables, variable_wrap="")
 
         self.assertTrue(function("a", "a"))
         self.assertFalse(function("a", "b"))
 
+        # A repeated cast of the same variable is only done once per call
+        example_repeated_expression, _ = StringBooleanExpression._parse_input("S$var_one==a||S$var_one==S$var_two", {})
+        function = StringBooleanExpression._set_up_function(example_repeated_expression, variables, variable_wrap="")
+        self.assertEqual(function.__code__.co_varnames, ("var_one", "var_two", "var_onestr"))
+        self.assertTrue(function(1, "1"))
+        self.assertTrue(function("a", "b"))
+        self.assertFalse(function("b", "a"))
+
+    def test__fold_constant(self):
+        self.assertEqual(StringBooleanExpression._fold_constant("bob", "str"), "bob")
+        self.assertEqual(StringBooleanExpression._fold_constant("10", "float"), 10.0)
+        self.assertEqual(StringBooleanExpression._fold_constant("10.7", "int"), 10)
+        self.assertEqual(StringBooleanExpression._fold_constant("1e999", "float"), float("inf"))
+        with self.assertRaises(ValueError):
+            StringBooleanExpression._fold_constant("1e400", "int")
+
+        with self.assertRaises(ValueError):
+            StringBooleanExpression._fold_constant("abc", "float")
+
+        with self.assertRaises(ValueError):
+            StringBooleanExpression("F$salary==abc")
+
     def test__parse_input(self):
         # Testing the parse function
         input_string = "S$var_one==var_two||S$var_one==TESTING"
 
-        output_parsed_string, variables = StringBooleanExpression._parse_input(input_string, {"TESTING": "an example"})
+        output_tree, variables = StringBooleanExpression._parse_input(input_string, {"TESTING": "an example"})
 
         self.assertTrue("var_one" in variables)
+        self.assertTrue("var_two" not in variables)
         self.assertTrue("TESTING" not in variables)
-        self.assertTrue("TESTING" not in output_parsed_string)
-        self.assertTrue("an example" in output_parsed_string)
+        self.assertTrue("TESTING" not in str(output_tree))
+        self.assertTrue("an example" in str(output_tree))
 
-    def test__handle_comparison(self):
-        # Testing handle comparison
-        input_string = "S$var_one==var_two||S$var_one==TESTING"
+        # Not binds tighter than and, which binds tighter than or
+        output_tree, _ = StringBooleanExpression._parse_input("!!S$a==b&&S$c==d||(S$e==f)", {})
+        self.assertIsInstance(output_tree, Or)
+        self.assertIsInstance(output_tree.operands[0], And)
+        self.assertIsInstance(output_tree.operands[0].operands[0], Not)
+        self.assertIsInstance(output_tree.operands[1], Comparison)
 
-        output_parsed_string, variables = StringBooleanExpression._handle_comparison(input_string, "==", "GARBAGE",
-                                                                                     {"TESTING": "an example"})
+        for invalid in ["", "S$a==", "(S$a==b", "S$a==b)", "1==1", "S$a==F$b", "X$a==b", "S$a b==c", "S$a==b||",
+                        "(" * 400 + "S$a==b" + ")" * 400, "!!(" * 51 + "S$a==b" + ")" * 51]:
+            with self.assertRaises(ValueError, msg=invalid[:10]):
+                StringBooleanExpression._parse_input(invalid, {})
 
-        self.assertTrue("var_one" in variables)
-        self.assertTrue("var_two" not in variables)
-        self.assertTrue("==" not in output_parsed_string)
-        self.assertTrue("GARBAGE" in output_parsed_string)
-        self.assertTrue("an example" in output_parsed_string)
-        self.assertTrue("TESTING" not in output_parsed_string)
+        # Nesting up to the limit is valid
+        nested = "S$a==b"
+        for index in range(MAX_NESTING):
+            nested = f"S$a==c{index}{'||' if index % 2 else '&&'}({nested})"
+        self.assertTrue(StringBooleanExpression(nested).simplify().check({"a": "c99"}))
+        self.assertTrue(StringBooleanExpression("!!" * MAX_NESTING + "S$a==b").check({"a": "b"}))
 
-    def test__wrap_string(self):
-        wrap = "wrapping"
-        not_wrapped = "value"
-        expected_wrap = wrap + not_wrapped + wrap
+    def test__tokenize(self):
+        tokens = StringBooleanExpression._tokenize("S$var_one==var two ||(!!F$x<<1.5)")
 
-        self.assertTrue(StringBooleanExpression._wrap_string(not_wrapped, wrap, True) == expected_wrap)
-        self.assertTrue(StringBooleanExpression._wrap_string(not_wrapped, wrap, False) == not_wrapped)
+        self.assertEqual(tokens, [("operand", "S$var_one"), ("comparison", "=="), ("operand", "var two "),
+                                  ("||", "||"), ("(", "("), ("!!", "!!"), ("operand", "F$x"),
+                                  ("comparison", "<<"), ("operand", "1.5"), (")", ")")])
 
     def test__check_for_invalid(self):
         invalid = "eval()"
@@ -117,3 +476,305 @@ class TestStringBooleanExpression(TestCase):
             StringBooleanExpression._check_for_invalid(valid)
         except ValueError:
             self.fail("Incorrectly threw exception on valid string")
+
+
+class TestRuleSet(TestCase):
+
+    def test_match(self):
+        rules = {
+            "bob": "S$name==bob",
+            "reverse bob": "bob==S$name",
+            "not bob": "!!S$name==bob",
+            "range": "F$salary>>10&&F$salary<=20",
+            "reverse range": "10<<F$salary&&20>=F$salary",
+            "bounds": "I$age<<18||I$age>=65",
+            "not equal": "S$name!=bob&&S$name!=jim",
+            "two variables": "F$salary>=F$bonus",
+            "complex": "something with a space==S$name||"
+                       "(S$name==bob||jim==S$name||(EMPTY_STRING==S$name&&S$name==EMPTY_STRING&&F$salary>=10.5))",
+        }
+        rule_set = RuleSet(rules)
+        expressions = {rule_id: StringBooleanExpression(rule) for rule_id, rule in rules.items()}
+
+        self.assertEqual(len(rule_set), len(rules))
+        # S$name==bob is shared by four rules
+        self.assertEqual(len(rule_set._predicates), 12)
+
+        records = [{}, {"name": "bob"}, {"name": "jim", "salary": 15, "age": 70, "bonus": 20},
+                   {"name": "", "salary": "10.5", "age": "17", "bonus": 1}, {"name": "al", "salary": 10, "age": 18},
+                   {"name": "something with a space", "salary": 20, "bonus": 20, "age": 65}]
+        for record in records:
+            expected = [rule_id for rule_id, expression in expressions.items() if expression.check(record)]
+            self.assertEqual(rule_set.match(record), expected, f"Matches check for {record}")
+
+    def test_match_uncastable(self):
+        # A field that can not be cast only affects the rules that compare it, which are evaluated like check
+        rules = {"a": "S$name==bob", "b": "I$age>>3", "c": "S$name==bob||F$salary>>10",
+                 "d": "S$name==bob||F$salary>=F$bonus"}
+        rule_set = RuleSet(rules)
+        self.assertEqual(rule_set.match({"name": "bob", "salary": "n/a"}), ["a", "c"])
+        self.assertEqual(rule_set.match({"name": "bob", "salary": "20", "bonus": "n/a"}), ["a", "c", "d"])
+        for record in [{"name": "jim", "salary": "n/a"}, {"name": "jim", "salary": "20", "bonus": "n/a"},
+                       {"name": "bob", "age": "x"}]:
+            with self.assertRaises(ValueError):
+                rule_set.match(record)
+
+        rule_set.add("e", "F$salary>>10||S$name==bob")
+        with self.assertRaises(ValueError):
+            rule_set.match({"name": "bob", "salary": "n/a"})
+
+    def test_add(self):
+        rule_set = RuleSet([("first", StringBooleanExpression("S$name==bob"))])
+        rule_set.add("second", "S$name==EMPTY_STRING")
+        self.assertEqual(rule_set.match({"name": ""}), ["second"])
+
+        # Rules made of the same comparisons share a function, and simplified expressions can be added
+        rule_set.add("third", "bob==S$name")
+        self.assertIs(rule_set._rules[2].function, rule_set._rules[0].function)
+        rule_set.add("fourth", StringBooleanExpression("F$salary>>10||(F$salary>>20&&S$name==bob)").simplify())
+        self.assertEqual(rule_set.match({"salary": 15}), [], "The simplified rule keeps the fields of the rule")
+        self.assertEqual(rule_set.match({"salary": 15, "name": "jim"}), ["fourth"])
+        self.assertEqual(rule_set.match({"salary": 15, "name": "bob"}), ["first", "third", "fourth"])
+
+        # No range is True for NaN
+        rule_set.add("nan", "F$salary<<nan||F$salary>=1||F$salary<<2")
+        self.assertEqual(rule_set.match({"salary": "1.5"}), ["nan"])
+        self.assertEqual(rule_set.match({"salary": "nan"}), [])
+
+        with self.assertRaises(ValueError):
+            rule_set.add("first", "S$name==jim")
+        with self.assertRaises(ValueError):
+            rule_set.add("third", "eval()")
+
+
+class TestIncrementalEvaluator(TestCase):
+    expressions = {"bob": "S$name==bob", "rich": "F$salary>=100&&!!S$name==bob", "either": "S$name==al||I$age<<18",
+                   "adult": "I$age>=18"}
+
+    def test_update(self):
+        evaluator = IncrementalEvaluator(self.expressions)
+        record = {"name": "bob", "salary": "50", "age": 30}
+        self.assertEqual(evaluator.evaluate("first", record),
+                         {"bob": True, "rich": False, "either": False, "adult": True})
+
+        record["salary"] = "500"
+        self.assertEqual(evaluator.update("first", record, ["salary"]), {}, "Short circuited by the name")
+        record["name"] = "al"
+        self.assertEqual(evaluator.update("first", record, {"name"}), {"bob": False, "rich": True, "either": True})
+
+        # Only expressions and nodes that use a changed field are evaluated again, so the bad age is never cast
+        record["age"] = "x"
+        record["salary"] = "1"
+        self.assertEqual(evaluator.update("first", record, ["salary"]), {"rich": False})
+        with self.assertRaises(ValueError):
+            evaluator.update("first", record, ["age"])
+        self.assertEqual(evaluator.results("first"), {"bob": False, "rich": False, "either": True, "adult": True},
+                         "An expression that raised keeps its previous result")
+
+        record["age"] = 5
+        del record["salary"]
+        self.assertEqual(evaluator.update("first", record, ["age", "salary", "other"]), {"adult": False})
+        record["name"] = "bob"
+        record["salary"] = "100"
+        self.assertEqual(evaluator.update("first", record, ["name", "salary"]), {"bob": True})
+
+        expected = {expression_id: StringBooleanExpression(expression).check(record)
+                    for expression_id, expression in self.expressions.items()}
+        self.assertEqual(evaluator.results("first"), expected)
+
+        evaluator.forget("first")
+        with self.assertRaises(KeyError):
+            evaluator.update("first", record, ["name"])
+
+    def test_update_raises(self):
+        # Nothing is updated when an expression raises, so a flip computed before it is not lost
+        evaluator = IncrementalEvaluator({1: "S$name==bob", 2: "I$age>>3&&S$name==bob"})
+        record = {"name": "jim", "age": "5"}
+        self.assertEqual(evaluator.evaluate("first", record), {1: False, 2: False})
+
+        record.update(name="bob", age="x")
+        with self.assertRaises(ValueError):
+            evaluator.update("first", record, ["name", "age"])
+        self.assertEqual(evaluator.results("first"), {1: False, 2: False})
+
+        record["age"] = "5"
+        self.assertEqual(evaluator.update("first", record, ["name", "age"]), {1: True, 2: True})
+
+    def test_add(self):
+        evaluator = IncrementalEvaluator([("bob", StringBooleanExpression("S$name==bob"))])
+        evaluator.evaluate("first", {"name": "bob"})
+        evaluator.add("al", "S$name==al")
+        self.assertEqual(len(evaluator), 2)
+        self.assertEqual(evaluator.update("first", {"name": "al"}, ["name"]), {"bob": False},
+                         "Records evaluated before an expression was added do not get its result")
+        self.assertEqual(evaluator.evaluate("first", {"name": "al"}), {"bob": False, "al": True})
+
+        with self.assertRaises(ValueError):
+            evaluator.add("bob", "S$name==jim")
+
+
+class TestDataset(TestCase):
+    records = [{"name": "bob", "salary": 5, "age": "30"}, {"name": "jim", "salary": 50.5}, {"salary": "20", "age": 17},
+               {"name": "al", "salary": float("nan"), "age": 40}, {"name": "bob", "salary": "100", "age": 2},
+               {"name": 5, "salary": -1, "age": 18}]
+
+    def test_query(self):
+        dataset = Dataset(self.records)
+        self.assertEqual(len(dataset), 6)
+        self.assertEqual(dataset[1], {"name": "jim", "salary": 50.5})
+
+        for input_string in ["S$name==bob", "S$name==bob&&F$salary>=10", "F$salary>>5||I$age<=17", "F$salary==50.5",
+                             "!!S$name==bob&&I$age>>10", "S$name!=al||F$salary<<0", "5==S$name", "F$age>=F$salary",
+                             "F$salary<=-1||(S$name==jim&&!!F$salary>=1000)", "S$other==bob"]:
+            expression = StringBooleanExpression(input_string)
+            expected = [position for position, record in enumerate(self.records) if expression.check(record)]
+            self.assertEqual(dataset.query(expression), expected, input_string)
+
+        self.assertEqual(dataset.select("S$name==bob"), [self.records[0], self.records[4]])
+
+    def test__candidates(self):
+        dataset = Dataset(self.records)
+        self.assertEqual(dataset._hash_indexes, {}, "Indexes are built when they are first used")
+        self.assertEqual(dataset._candidates(StringBooleanExpression("S$name==bob&&F$salary>=10")._tree), {4})
+        self.assertEqual(dataset._candidates(StringBooleanExpression("S$name==jim||I$age<<18")._tree), {1, 2, 4})
+        self.assertIsNone(dataset._candidates(StringBooleanExpression("S$name==jim||!!I$age<<18")._tree))
+        self.assertEqual(set(dataset._hash_indexes), {"name"})
+        self.assertEqual(set(dataset._sorted_indexes), {("salary", "float"), ("age", "int")})
+
+    def test_query_invalid(self):
+        records = [{"name": "bob", "salary": 5}, {"name": "jim", "salary": "x"}]
+        with self.assertRaises(ValueError, msg="Rows that can not be cast are checked even when no index matches"):
+            Dataset(records).query("S$name==jim&&F$salary>=10")
+        self.assertEqual(Dataset(records).query("S$name==bob&&F$salary>=1"), [0])
+
+
+class TestStreaming(TestCase):
+    lines = ['{"name": "bob", "salary": 5}\n', '\n', '{"name": "jim", "salary": 50}\n', '{"other": 1}\n', '[1]\n',
+             '{"n\\u0061me": "bob", "salary": 1}\n']
+
+    def test_filter_stream(self):
+        records = [{"name": "bob"}, {"name": "jim"}, {}] * 5
+        self.assertEqual(list(filter_stream("S$name==bob", records, batch_size=2)), [{"name": "bob"}] * 5)
+        self.assertEqual(list(filter_stream(StringBooleanExpression("S$name==al"), records)), [])
+
+        with self.assertRaises(ValueError):
+            list(filter_stream("S$name==bob", records, batch_size=0))
+
+    def test_filter_jsonl(self):
+        self.assertEqual(list(filter_jsonl("S$name==bob||F$salary>>10", self.lines, batch_size=2)),
+                         [self.lines[0], self.lines[2], self.lines[5]])
+
+        with self.assertRaises(ValueError):
+            list(filter_jsonl("S$name==bob", ['{"name": \n']))
+        self.assertEqual(list(filter_jsonl("S$name==bob", ['{"other": \n'])), [],
+                         "A line without every field is skipped without being decoded")
+
+    def test_filter_csv(self):
+        header = ["name", "salary"]
+        rows = [["bob", "5"], ["jim", "50"], ["al"], ["al", "1"]]
+        self.assertEqual(list(filter_csv("S$name==bob||F$salary>>10", rows, header)), rows[:2])
+        self.assertEqual(list(filter_csv("S$other==bob", rows, header)), [], "A missing column never matches")
+
+    def test_check_parallel(self):
+        records = [{"name": "bob", "salary": index} for index in range(10)] + [{"salary": 1}]
+        self.assertEqual(list(check_parallel("F$salary>=5", records, processes=2, chunk_size=3)),
+                         [index >= 5 for index in range(10)] + [False])
+        self.assertEqual(list(check_parallel("F$salary>=5", [], processes=2)), [])
+        self.assertEqual(list(check_parallel("S$name==bob||F$salary>>10", self.lines, processes=2, chunk_size=2,
+                                             record_format="jsonl")), [True, False, True, False, False, True])
+        self.assertEqual(list(check_parallel("F$salary>=5", [["bob", "5"], ["jim"], ["al", "1"]], processes=2,
+                                             record_format="csv", header=["name", "salary"])), [True, False, False])
+
+        with self.assertRaises(ValueError):
+            list(check_parallel("F$salary>=5", records, record_format="xml"))
+
+    def test_count_parallel(self):
+        self.assertEqual(count_parallel("S$name==bob", self.lines * 5, processes=2, chunk_size=4, record_format="jsonl"),
+                         10)
+
+    def test_filter_sqlite(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute('CREATE TABLE "people" (name TEXT, salary INTEGER, age REAL, nickname)')
+        connection.execute("CREATE INDEX people_name ON people (name)")
+        rows = [("bob", 5, 30.0, "b"), ("jim", 50, 17.0, "bob"), ("al", None, 40.0, "al"), (None, 1, 1.0, "x"),
+                ("bob", 20, 2.5, None), ("sue", 100, 60.0, "10"), ("kim", 2.5, 3.0, "k")]
+        connection.executemany("INSERT INTO people VALUES (?, ?, ?, ?)", rows)
+
+        for input_string in ["S$name==bob", "F$salary>>10||I$age<<18", "!!(S$name==bob&&I$age>=3)", "S$nickname==S$name",
+                             "F$salary>=5&&S$name!=EMPTY_STRING", "S$name>=c&&F$age<=40.0", "I$salary<=2",
+                             "F$age>=F$salary||!!F$salary>>10"]:
+            expression = StringBooleanExpression(input_string)
+            expected = [row for row in rows if expression.check({field: value for field, value in
+                                                                 zip(["name", "salary", "age", "nickname"], row)
+                                                                 if value is not None})]
+            self.assertEqual(list(filter_sqlite(expression, connection, "people")), expected, input_string)
+
+        self.assertEqual(list(filter_sqlite("S$name==bob", connection, "people", columns=["age"])), [(30.0,), (2.5,)])
+        self.assertEqual(list(filter_sqlite("S$missing==bob", connection, "people")), [])
+        with self.assertRaises(ValueError):
+            filter_sqlite("S$name==bob", connection, "missing")
+
+        condition, parameters = StringBooleanExpression("S$name==bob").to_sql({"name": "TEXT"})
+        plan = connection.execute(f"EXPLAIN QUERY PLAN SELECT * FROM people WHERE {condition}", parameters).fetchall()
+        self.assertIn("people_name", str(plan), "The index on name is used")
+
+        connection.execute("CREATE INDEX people_salary ON people (salary)")
+        condition, parameters = StringBooleanExpression("F$salary>>10").to_sql({"salary": "INTEGER"})
+        plan = connection.execute(f"EXPLAIN QUERY PLAN SELECT * FROM people WHERE {condition}", parameters).fetchall()
+        self.assertIn("people_salary", str(plan), "The index on salary is used for a float comparison")
+        self.assertEqual(sorted(filter_sqlite("F$salary>>10", connection, "people", columns=["name"])),
+                         [("bob",), ("jim",), ("sue",)])
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl_path = os.path.join(directory, "input.jsonl")
+            with open(jsonl_path, "w") as jsonl_file:
+                jsonl_file.writelines(self.lines)
+            csv_path = os.path.join(directory, "input.csv")
+            with open(csv_path, "w") as csv_file:
+                csv_file.write("name,salary\nbob,5\njim,50\nal,1\n")
+
+            for arguments, expected_output, expected_code in [
+                (["S$name==bob", jsonl_path], self.lines[0] + self.lines[5], 0),
+                (["--count", "S$name==bob", jsonl_path, jsonl_path], "4\n", 0),
+                (["--max-matches", "3", "S$name==bob", jsonl_path, jsonl_path], self.lines[0] + self.lines[5] +
+                 self.lines[0], 0),
+                (["S$name==al", jsonl_path], "", 1),
+                (["--format", "csv", "F$salary>=5", csv_path, csv_path], "name,salary\nbob,5\njim,50\nbob,5\njim,50\n",
+                 0),
+                (["--processes", "2", "--batch-size", "2", "S$name==bob", jsonl_path], self.lines[0] + self.lines[5], 0),
+                (["-p", "2", "--format", "csv", "--count", "F$salary>=5", csv_path], "2\n", 0),
+            ]:
+                with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                    self.assertEqual(main(arguments), expected_code, arguments)
+                self.assertEqual(stdout.getvalue(), expected_output, arguments)
+
+            with mock.patch("sys.stdin", io.StringIO("".join(self.lines))), \
+                    mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                main(["S$name==jim"])
+            self.assertEqual(stdout.getvalue(), self.lines[2], "Reads stdin without files")
+
+            # Lines that can not be decoded or cast are reported with their line number instead of a traceback, and
+            # so are files that can not be read and invalid options
+            bad_lines = '{"name":"bob","salary":"bad"}\n{"name":"jim","salary":"bad"}\n{"name":\n'
+            for arguments, error in [
+                (["--count", "S$name==bob||F$salary>>1"], "- line 2: could not convert"),
+                (["--count", "S$name==bob"], "- line 3: Expecting value"),
+                (["-p", "2", "--batch-size", "2", "F$salary>>1"], "- line 1: could not convert"),
+                (["--format", "csv", "F$salary>>1"], "- line 3: could not convert"),
+                (["S$name==bob", jsonl_path, os.path.join(directory, "missing.jsonl")], "No such file or directory"),
+                (["--max-matches", "-1", "S$name==bob"], "--max-matches must be at least 0: -1"),
+                (["--batch-size", "0", "S$name==bob"], "--batch-size must be at least 1: 0"),
+            ]:
+                input_text = "name,salary\nbob,5\njim,bad\n" if "csv" in arguments else bad_lines
+                with mock.patch("sys.stdin", io.StringIO(input_text)), \
+                        mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, \
+                        mock.patch("sys.stderr", new_callable=io.StringIO) as stderr, \
+                        self.assertRaises(SystemExit) as context:
+                    main(arguments)
+                self.assertEqual(context.exception.code, 2, arguments)
+                self.assertIn(error, stderr.getvalue(), arguments)
+                self.assertNotIn("Traceback", stderr.getvalue(), arguments)
+
+        with mock.patch("sys.stderr", new_callable=io.StringIO), self.assertRaises(SystemExit):
+            main(["eval()"])